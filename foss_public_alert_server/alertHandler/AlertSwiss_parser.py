@@ -7,8 +7,7 @@ import requests
 import xml.etree.ElementTree as ET
 import logging
 
-from django.http import HttpResponseBase
-
+from .exceptions import NothingChangedException
 from .abstract_CAP_parser import AbstractCAPParser
 
 from lib.alertswiss import AlertSwiss
@@ -26,7 +25,7 @@ class AlertSwissParser(AbstractCAPParser):
 
     def get_json(self, url):
         try:
-            req = self.session.get(url)
+            req = self.fetch(url)
             if not req.ok:
                 logger.error(f"Fetch error {req.status_code}: {url}")
                 return None
@@ -38,12 +37,17 @@ class AlertSwissParser(AbstractCAPParser):
     def _load_alerts_from_feed(self):
         alerts = {}
 
-        # this neither supports If-Modified-Since nor If-None-Match (etags)...
-        for lang in self.languages:
-            response = requests.get(self.feed_source.cap_alert_feed.replace("{LANG}", lang), timeout=10)
-            if response.status_code != HttpResponseBase.status_code:
-                raise "Feed status code is not 200"
+        # this neither supported If-Modified-Since nor If-None-Match (etags) last time we checked,
+        # but that doesn't hurt. The feed only changed if any of the language variants changed.
+        responses = [self.fetch(self.feed_source.cap_alert_feed.replace("{LANG}", lang)) for lang in self.languages]
+        self.feed_response_headers = responses[0].headers
+        if all(response.from_cache for response in responses) and self.last_fetch_was_complete():
+            raise NothingChangedException("Nothing changed")
+        for response in responses:
+            response.raise_for_status()
+        self.check_feed_content(*(response.content for response in responses))
 
+        for lang, response in zip(self.languages, responses):
             feed_data = json.loads(response.content)
             for alert in feed_data["alerts"]:
                 ident = alert["identifier"]
@@ -4,19 +4,18 @@
 
 import datetime
 import io
-import requests
 import zipfile
 import logging
 
-from django.http import HttpResponseNotModified, HttpResponseBase
-
-from .exceptions import NothingChangedException
+from django.core.cache import cache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from .abstract_CAP_parser import AbstractCAPParser
-from sourceFeedHandler.models import CAPFeedSource
+
+# how long the zip member checksums are kept if the feed isn't fetched anymore
+ZIP_MEMBER_CACHE_TIMEOUT = 60 * 60 * 24
 
 
 class DWDCAPParser(AbstractCAPParser):
@@ -25,21 +24,25 @@ class DWDCAPParser(AbstractCAPParser):
         super().__init__(feed_source, "dwd_parser")
 
     def _load_alerts_from_feed(self):
-        # use last e tag to reduce network usage
-        headers = {
-            "If-None-Match": self.feed_source.last_e_tag,  # what if None?
-        }
-        response = requests.get(self.feed_source.cap_alert_feed, headers=headers, timeout=10)  # @todo why not cached?
-        if response.status_code == HttpResponseNotModified.status_code:
-            raise NothingChangedException("Nothing changed")
-        elif response.status_code != HttpResponseBase.status_code:
-            raise "Feed status code is not 200"
-
-        # update etag and store it in the database
-        new_etag = response.headers.get("ETag")
-        CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_e_tag=new_etag)
-
-        zip_file = zipfile.ZipFile(io.BytesIO(response.content), 'r')
-        for cap_file in zip_file.namelist():
-            cap_data = zip_file.read(cap_file).decode('utf-8')
-            self.addAlert(cap_data=cap_data)
+        response = self.fetch_feed()
+
+        # the CRC32 and resulting alert id of every zip member of the last fetch, unchanged members
+        # of alerts we still have don't need to be decompressed and parsed again
+        cache_key = f"dwd-zip-members:{self.feed_source.source_id}"
+        previous_members: dict = cache.get(cache_key, {})
+        members = {}
+
+        with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zip_file:
+            for member in zip_file.infolist():
+                previous = previous_members.get(member.filename)
+                if previous and previous[0] == member.CRC and previous[1] in self.known_alerts:
+                    self.record_unchanged_alert(previous[1])
+                    members[member.filename] = previous
+                    continue
+
+                cap_data = zip_file.read(member).decode('utf-8')
+                alert_id = self.addAlert(cap_data=cap_data)
+                if alert_id:
+                    members[member.filename] = (member.CRC, alert_id)
+
+        cache.set(cache_key, members, timeout=ZIP_MEMBER_CACHE_TIMEOUT)
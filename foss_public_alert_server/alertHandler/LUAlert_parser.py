@@ -4,10 +4,8 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import datetime
-import requests
 
 from .abstract_CAP_parser import AbstractCAPParser
-from .models import Alert
 
 
 class LUAlertParser(AbstractCAPParser):
@@ -17,12 +15,12 @@ class LUAlertParser(AbstractCAPParser):
     def _load_alerts_from_feed(self):
         filenames = []
 
-        response: dict = requests.get(self.feed_source.cap_alert_feed, timeout=10).json()
+        response: dict = self.fetch_feed().json()
         for alerts in response:
             try:
                 cap_ident = alerts['identifier']
-                sent_time = datetime.datetime.utcfromtimestamp(alerts['sent'] / 1000)
-                if len(Alert.objects.filter(source_id=self.feed_source.source_id, alert_id=cap_ident, issue_time=sent_time)) == 1:
+                sent_time = datetime.datetime.fromtimestamp(alerts['sent'] / 1000, datetime.timezone.utc)
+                if self.is_known_alert(cap_ident, sent_time):
                     self.record_unchanged_alert(cap_ident)
                     continue
             except Exception:
@@ -30,8 +28,11 @@ class LUAlertParser(AbstractCAPParser):
 
             filenames.append(f"dump-alert.{alerts['identifier'].split('.')[1]}.xml")
 
-        metadata: dict = requests.get("https://data.public.lu/api/1/datasets/alertes-du-systeme-lu-alert/").json()
+        if not filenames:
+            return
+
+        metadata: dict = self.fetch("https://data.public.lu/api/1/datasets/alertes-du-systeme-lu-alert/").json()
         for resource in metadata["resources"]:
             if resource["title"] in filenames:
-                alert = requests.get(resource["url"])
+                alert = self.fetch(resource["url"])
                 self.addAlert(cap_source_url=resource["url"], cap_data=alert.content.decode('utf-8').replace('xmlns="urn:oasis:names:tc:emergency:cap:1.2:profile:cap-lu:1.0"', 'xmlns="urn:oasis:names:tc:emergency:cap:1.2"'))
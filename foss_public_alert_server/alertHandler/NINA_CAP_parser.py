@@ -7,17 +7,11 @@ import requests
 import xml.etree.ElementTree as ET
 import logging
 
-from django.http import HttpResponseNotModified, HttpResponseBase
-
-from .exceptions import NothingChangedException
-
 from lib.bbk import BBK
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from sourceFeedHandler.models import CAPFeedSource
-
 from .abstract_CAP_parser import AbstractCAPParser
 
 # Parser for BBK's CAP-like JSON API
@@ -32,40 +26,37 @@ class NinaCapParser(AbstractCAPParser):
         super().__init__(feed_source, "nina_parser")
 
     def get_json(self, url):
+        """
+        conditionally fetch and decode a JSON document
+        :return: the decoded document and whether it is unchanged since the last fetch, (None, False) on errors
+        """
         try:
-            req = self.session.get(url, timeout=10)
+            req = self.fetch(url)
             if not req.ok:
                 logger.error(f"Fetch error {req.status_code}: {url}")
-                return None
+                return None, False
         except requests.exceptions.ConnectionError as e:
             logger.error(f"Connection error: {url}",exc_info=True)
-            return None
-        return req.json()
+            return None, False
+        return req.json(), req.from_cache
 
     def _load_alerts_from_feed(self):
-        # use last e tag to reduce network usage
-        headers = {
-            "If-None-Match": self.feed_source.last_e_tag,
-        }
-        response = requests.get(self.feed_source.cap_alert_feed, headers=headers)
-        if response.status_code == HttpResponseNotModified.status_code:
-            raise NothingChangedException("Nothing changed")
-        elif response.status_code != HttpResponseBase.status_code:
-            raise "Feed status code is not 200"
-
-        # update etag and store it in the database
-        new_etag = response.headers.get("ETag")
-        # print(f"etag is {new_etag}")
-        CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_e_tag=new_etag)
+        response = self.fetch_feed()
 
         feed_data = json.loads(response.content)
         for alert_id_obj in feed_data:
             alert_id = alert_id_obj["id"]
 
             alert_url = f"https://warnung.bund.de/api31/warnings/{alert_id}.json"
-            alert = self.get_json(alert_url)
-            geojson = self.get_json(f"https://warnung.bund.de/api31/warnings/{alert_id}.geojson")
+            alert, alert_unchanged = self.get_json(alert_url)
+            geojson, geojson_unchanged = self.get_json(f"https://warnung.bund.de/api31/warnings/{alert_id}.geojson")
             if not alert or not geojson:
+                self.fetch_complete = False
+                continue
+            # known alerts are keyed by the CAP identifier, which isn't necessarily the id of the JSON API
+            cap_identifier = alert.get('identifier')
+            if alert_unchanged and geojson_unchanged and cap_identifier in self.known_alerts:
+                self.record_unchanged_alert(cap_identifier)
                 continue
 
             root = BBK.json_to_cap(alert)
@@ -8,16 +8,16 @@ import requests
 import logging
 import feedparser
 import os
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 from feedparser import FeedParserDict
 from dateutil import parser
 
 from django.conf import settings
 
-from .exceptions import NothingChangedException
 from .abstract_CAP_parser import AbstractCAPParser
-from .models import Alert
-from sourceFeedHandler.models import CAPFeedSource
 from lib import cap_feed
 
 logging.basicConfig(level=logging.INFO)
@@ -35,19 +35,14 @@ class XMLCAPParser(AbstractCAPParser):
 
     def _load_alerts_from_feed(self):
         logger.debug(f"fetching: {self.feed_source.source_id}")
-        # use etags to reduce network load
-        last_e_tag = self.feed_source.last_e_tag
         feed: FeedParserDict
 
         verify = True
         if self.feed_source.source_id in BROKEN_CHAIN_FEEDS:
             verify = BROKEN_CHAIN_FILE
 
+        feed_request = self.fetch_feed(verify=verify)
         try:
-            headers = {'User-Agent': settings.USER_AGENT}
-            if last_e_tag is not None:
-                headers['If-None-Match'] = last_e_tag
-            feed_request = requests.get(self.feed_source.cap_alert_feed, verify=verify, headers=headers, timeout=10)
             feed: FeedParserDict = feedparser.parse(feed_request.content)
 
             # check if the feed contains any error and raise Exception if so
@@ -62,14 +57,8 @@ class XMLCAPParser(AbstractCAPParser):
             # feedparser tries to parse the feed anyway
             warnings.warn(f"NonXMLContentType - feed does not follow RFC 3023. Parse anyway. - {e}")
 
-        if feed_request.status_code == 304:
-            raise NothingChangedException("Nothing changed")
-
-        # check if header has en etag and if yes update the etag in the database
-        if "etag" in feed_request.headers:
-            new_etag = feed_request.headers["etag"]
-            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_e_tag=new_etag)
-
+        # the CAP messages to download, as (url, identifier) tuples
+        downloads = []
         for entry in feed['entries']:
             # find the link to the CAP source
             cap_source_url = ''
@@ -89,33 +78,56 @@ class XMLCAPParser(AbstractCAPParser):
 
             # if we have an identifier and sent time available here, check whether we
             # know the alert already
+            cap_ident = entry.get('cap_identifier')
             try:
-                cap_ident = entry.get('cap_identifier')
                 cap_sent = entry.get('cap_sent')
-                if cap_ident is not None and cap_sent is not None:
-                    sent_time = parser.isoparse(cap_sent)
-                if len(Alert.objects.filter(source_id=self.feed_source.source_id, alert_id=cap_ident, issue_time=sent_time)) == 1:
+                if cap_ident is not None and cap_sent is not None \
+                        and self.is_known_alert(cap_ident, parser.isoparse(cap_sent)):
                     self.record_unchanged_alert(cap_ident)
                     continue
             except Exception:
                 pass
 
-            try:
-                if self.feed_source.source_id in BROKEN_CHAIN_FEEDS:
-                    # upgrade http to https as a workaround for za-saws-en
-                    cap_source_url = cap_source_url.replace('http://', 'https://')
-                req = self.session.get(cap_source_url, headers={'User-Agent': settings.USER_AGENT}, verify=verify, timeout=10)
-                if not req.ok:
-                    logger.error(f"Fetch error {req.status_code}: {cap_source_url}")
+            if self.feed_source.source_id in BROKEN_CHAIN_FEEDS:
+                # upgrade http to https as a workaround for za-saws-en
+                cap_source_url = cap_source_url.replace('http://', 'https://')
+            downloads.append((cap_source_url, cap_ident))
+
+        # download the CAP messages concurrently, but process them in feed order on this thread
+        origin_limits = {}
+        for cap_source_url, cap_ident in downloads:
+            origin = urlsplit(cap_source_url).netloc
+            if origin not in origin_limits:
+                origin_limits[origin] = threading.BoundedSemaphore(settings.CAP_DOWNLOADS_PER_ORIGIN)
+
+        def download(cap_source_url: str) -> requests.Response:
+            with origin_limits[urlsplit(cap_source_url).netloc]:
+                # revalidate the stored copy, CAP messages may be updated under the same url
+                return self.fetch(cap_source_url, verify=verify)
+
+        executor = ThreadPoolExecutor(max_workers=settings.CAP_DOWNLOAD_THREADS, thread_name_prefix="cap-download")
+        try:
+            futures = [executor.submit(download, cap_source_url) for cap_source_url, cap_ident in downloads]
+            for (cap_source_url, cap_ident), future in zip(downloads, futures):
+                try:
+                    req = future.result()
+                    if not req.ok:
+                        logger.error(f"Fetch error {req.status_code}: {cap_source_url}")
+                        self.fetch_complete = False
+                        continue
+                except requests.exceptions.ConnectionError:
+                    logger.error(f"Connection error: {cap_source_url}")
+                    self.fetch_complete = False
                     continue
-            except requests.exceptions.ConnectionError:
-                logger.error(f"Connection error: {cap_source_url}")
-                continue
 
-            if req.from_cache and cap_ident:
-                self.record_unchanged_alert(cap_ident)
-                continue
+                # unchanged alerts we failed to store last time have to be processed again
+                if req.from_cache and cap_ident in self.known_alerts:
+                    self.record_unchanged_alert(cap_ident)
+                    continue
 
-            cap_data = req.content.decode('utf-8')
-            # add alert to database
-            self.addAlert(cap_source_url=cap_source_url, cap_data=cap_data)
\ No newline at end of file
+                cap_data = req.content.decode('utf-8')
+                # add alert to database
+                self.addAlert(cap_source_url=cap_source_url, cap_data=cap_data)
+        finally:
+            # don't wait for the remaining downloads if processing got aborted
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -2,19 +2,20 @@
 # SPDX-FileCopyrightText: Volker Krause <vkrause@kde.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
 import os
 import xml
 import xml.etree.ElementTree as ET
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
-import requests_cache
-import json
 import warnings
 import logging
 import socket
+import threading
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Q
 
 from celery import shared_task
 
@@ -22,6 +23,9 @@ from celery import shared_task
 from .exceptions import AlertExpiredException, DatabaseWritingException, AlertParameterException, \
     NoGeographicDataAvailableException, NothingChangedException
 from .models import Alert
+from .area_cache import bump_alert_generation
+from .geocode_store import geocode_store
+from .http_session import get_cached_session
 from sourceFeedHandler.models import CAPFeedSource
 from foss_public_alert_server.celery import app as celery_app
 from subscriptionHandler.tasks import check_for_alerts_and_send_notifications
@@ -41,6 +45,23 @@ if not settings.DEBUG:
 # and potentially blocks other tasks for several minutes.
 socket.setdefaulttimeout(10)
 
+# Warnings (aka error messages) raised while processing a feed are collected per thread,
+# as feeds are processed concurrently by the threads of the feed worker.
+_feed_warnings = threading.local()
+_default_showwarning = warnings.showwarning
+
+
+def _collect_feed_warning(message, category, filename, lineno, file=None, line=None):
+    warnings_list = getattr(_feed_warnings, 'warnings_list', None)
+    if warnings_list is None:
+        _default_showwarning(message, category, filename, lineno, file, line)
+    else:
+        warnings_list.append(f"{category.__name__}: {message}")
+
+
+# write warning not to standard out but to the list of the current feed
+warnings.showwarning = _collect_feed_warning
+
 feed_alert_count_metric = Gauge('fpas_alert_count', 'Active alerts in a CAP feed', ['feed'], multiprocess_mode='mostrecent')
 feed_fetch_duration_metric = Gauge('fpas_feed_fetch_time', 'CAP feed fetch time', ['feed'], multiprocess_mode='mostrecent')
 
@@ -51,14 +72,81 @@ class AbstractCAPParser(ABC):
     parser = None
     name = None
     list_of_current_alert_ids = []
+    known_alerts: dict = None
+    # number of alerts added or updated during the current fetch
+    alerts_changed: int = 0
+    # the HTTP response headers of the feed, to be set by the parser implementations if available
+    feed_response_headers = None
+    # hash of the feed content of the current fetch, stored once the fetch succeeded
+    feed_content_hash: str = None
+    # to be set to False by parser implementations if they had to skip alerts because of errors,
+    # the same feed content is then processed again next time
+    fetch_complete: bool = True
 
     def __init__(self, feed_source, name: str):
         self.feed_source = feed_source
-        self.session = requests_cache.session.CachedSession(cache_name='cache/' + self.feed_source.source_id, expire_after=60*60*24)
-        self.session.cache.delete(expired=True)
-        self.session.cache.delete(invalid=True)
+        self.known_alerts = {}
+        self.session = get_cached_session()
         self.name = name
 
+    def fetch(self, url: str, **kwargs):
+        """
+        conditionally fetch the given url.
+        ETag and Last-Modified of previous responses are stored per url in the cache of this parser and sent as
+        If-None-Match/If-Modified-Since, so unchanged documents only cost a header exchange.
+        :param url: the url to fetch
+        :param kwargs: additional arguments for the request, e.g. verify
+        :return: the response, response.from_cache is true if the server confirmed that the stored copy is current
+        """
+        headers = {'User-Agent': settings.USER_AGENT}
+        headers.update(kwargs.pop('headers', {}))
+        return self.session.get(url, headers=headers, timeout=kwargs.pop('timeout', 10), refresh=True, **kwargs)
+
+    def fetch_feed(self, url: str = None, **kwargs):
+        """
+        conditionally fetch the feed, see fetch()
+        :param url: the url of the feed, defaults to the url of the feed source
+        :param kwargs: additional arguments for the request, e.g. verify
+        :return: the response
+        :raise NothingChangedException: if the feed didn't change since the last complete fetch
+        :raise requests.HTTPError: if the server replied with an error
+        """
+        response = self.fetch(url or self.feed_source.cap_alert_feed, **kwargs)
+        self.feed_response_headers = response.headers
+        if response.from_cache and self.last_fetch_was_complete():
+            raise NothingChangedException("Nothing changed")
+        response.raise_for_status()
+        self.check_feed_content(response.content)
+
+        # the conditional requests use the cache, the etag is only stored for diagnostics
+        new_etag = response.headers.get("ETag")
+        if new_etag != self.feed_source.last_e_tag:
+            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_e_tag=new_etag)
+        return response
+
+    def last_fetch_was_complete(self) -> bool:
+        """
+        check if the last fetch of the feed processed all alerts, otherwise an unchanged feed has to be processed again
+        to retry the failed alerts. No content hash is stored for incomplete fetches.
+        :return: true if the feed doesn't need to be processed again as long as it is unchanged
+        """
+        return self.feed_source.last_content_hash is not None
+
+    def check_feed_content(self, *contents: bytes) -> None:
+        """
+        check if the feed content changed since the last successful fetch, for feeds that don't support
+        conditional requests or that reply with the same content anyway
+        :param contents: the feed content, or the contents of all requests together forming the feed
+        :return: None
+        :raise NothingChangedException: if the content is identical to the last successfully processed one
+        """
+        digest = hashlib.sha256()
+        for content in contents:
+            digest.update(content)
+        self.feed_content_hash = digest.hexdigest()
+        if self.feed_content_hash == self.feed_source.last_content_hash:
+            raise NothingChangedException("Nothing changed")
+
     @abstractmethod
     def _load_alerts_from_feed(self):
         """
@@ -75,14 +163,22 @@ class AbstractCAPParser(ABC):
         """
         store_warnings = True
         warnings_list = []
+        # whether the alerts of the feed changed, None if we couldn't check
+        changed = None
         self.list_of_current_alert_ids = []
-
-        # configure warnings (aka error messages) to append every warning to our list of warnings
-        def collect_warnings(message, category, filename, lineno, file=None, line=None):
-            warnings_list.append(f"{category.__name__}: {message}")
-
-        # write warning not to standard out but to our custom methode
-        warnings.showwarning = collect_warnings
+        self.alerts_changed = 0
+        self.feed_response_headers = None
+        self.feed_content_hash = None
+        self.fetch_complete = True
+        # the sent time of all alerts of this source we already have, to detect unchanged alerts without a query per alert
+        # expired alerts are not considered, they need to be parsed again to be removed
+        self.known_alerts = dict(Alert.objects.filter(Q(source_id=self.feed_source.source_id)
+                                                      & (Q(expire_time__isnull=True)
+                                                         | Q(expire_time__gt=datetime.now(timezone.utc))))
+                                 .values_list('alert_id', 'issue_time'))
+
+        # append every warning of this thread to our list of warnings
+        _feed_warnings.warnings_list = warnings_list
 
         try:
             # store the start time to measure the feeds update time
@@ -102,64 +198,64 @@ class AbstractCAPParser(ABC):
 
             # delete all old alerts in the database
             feed_alert_count_metric.labels(self.feed_source.source_id).set(len(self.list_of_current_alert_ids))
-            for alert in Alert.objects.filter(source_id=self.feed_source.source_id):
-                if alert.alert_id not in self.list_of_current_alert_ids:
-                    logger.debug(f"{alert.alert_id} is no longer in the feed. Deleting...")
-                    alert.delete()
+            deleted = Alert.objects.filter(Q(source_id=self.feed_source.source_id)
+                                           & ~Q(alert_id__in=self.list_of_current_alert_ids)).delete_with_cap_data()
+            logger.debug(f"{self.feed_source.source_id} - deleted {deleted} alerts no longer in the feed")
+            changed = self.alerts_changed > 0 or deleted > 0
+
+            # remember what we processed, unless we have to retry some alerts next time
+            CAPFeedSource.objects.filter(id=self.feed_source.id).update(
+                last_content_hash=self.feed_content_hash if self.fetch_complete else None)
 
         except NothingChangedException:
             logger.debug(f"{self.feed_source.source_id} - nothing changed")
+            changed = False
             CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=True)
             # do not store empty warnings if we just checked for changes
             store_warnings = False
+        # the failed fetches below don't store a content hash, so the feed is processed again even if it is unchanged
         except ET.ParseError as e:
             logger.exception(f"{self.feed_source.source_id} - failed to parse CAP alert message XML:", exc_info=e)
             warnings.warn(f"Failed to parse CAP alert message XML {e}")
-            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False)
+            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False, last_content_hash=None)
         except DatabaseWritingException as e:
             logger.exception(f"Something went wrong while writing in the database  "
                              f"{self.feed_source.source_id}", exc_info=e)
-            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False)
+            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False, last_content_hash=None)
             # do not add database exceptions to warnings because they could include sensitive information
             warnings_list.append("Database writing error")
         except Exception as e:
             logger.exception(f"Something went wrong while getting the feed {self.feed_source.source_id}", exc_info=e)
-            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False)
+            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_status=False, last_content_hash=None)
             # add exceptions to warnings_lis
             warnings_list.append(str(e))
 
         if store_warnings:
             # store warnings in database
             CAPFeedSource.objects.filter(id=self.feed_source.id).update(feed_warnings=str(warnings_list)[:255])
+        _feed_warnings.warnings_list = None
 
         # store duration as last fetch duration
         fetch_duration = datetime.now() - start_time
         CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_fetch_duration=fetch_duration)
         feed_fetch_duration_metric.labels(self.feed_source.source_id).set(fetch_duration.total_seconds())
 
+        # poll feeds less often while they don't change
+        self.feed_source.adapt_update_interval(changed, fetch_duration, self.feed_response_headers)
+
     def load_geocode(self, code_name: str, code_value: str):
         """
         Load GeoJSON geometry for a given CAP geo code.
         Returns None if not found.
         """
-        code_file = os.path.join(settings.BASE_DIR, 'alertHandler/data', code_name, f"{code_value}.geojson")
-        if os.path.isfile(code_file):
-            return json.load(open(code_file))
+        return geocode_store.lookup(code_name, code_value)
 
-        # for hierarchical CPEAS codes check if we have a parent code at least
-        if code_name == "CPEAS Geographic Code":
-            for i in range(0, 3):
-                parent_code = code_value[0:6 - i*2] + '0000000000'[4-i*2:]
-                if parent_code != code_value:
-                    return self.load_geocode(code_name, parent_code)
-
-        return None
-
-    def expand_geocode(self, cap_tree: xml) -> [bool]:
+    def expand_geocode(self, cap_tree: xml, expanded_geocodes: list = None) -> [bool]:
         """
         Some sources do not contain the polygons of the area directly in the CAP file, but use geocodes instead.
         If necessary, we add the polygons to the file as geojson.
         :param cap_tree: the original cap xml tree
+        :param expanded_geocodes: optional list, the (code name, code value) tuples of all expanded geocodes are appended to it
         :return: true if the data is expanded false if not
         """
         expanded: bool = False
@@ -179,6 +275,8 @@ class AbstractCAPParser(ABC):
                 if geojson is not None:
                     # append geojson to original file
                     expanded = cap_geojson.geojson_feature_to_cap(area, geojson) or expanded
+                    if expanded_geocodes is not None:
+                        expanded_geocodes.append((code_name, code_value))
                 else:
                     if is_first_error_for_source:
                         is_first_error_for_source = False
@@ -220,10 +318,12 @@ class AbstractCAPParser(ABC):
                 new_alert.id = alerts[0].id
                 old_path = alerts[0].cap_data.path
                 new_alert.save(force_update=True)
+                bump_alert_generation()
                 os.remove(old_path)
                 check_for_alerts_and_send_notifications(new_alert, True)
             else:
                 new_alert.save()
+                bump_alert_generation()
                 # check if there are subscription
                 check_for_alerts_and_send_notifications(new_alert)
         except Exception as e:
@@ -241,28 +341,42 @@ class AbstractCAPParser(ABC):
         elif sent_time > latest_entry.latest_published_alert_datetime:
             CAPFeedSource.objects.filter(id=self.feed_source.id).update(latest_published_alert_datetime=sent_time)
 
-    def addAlert(self, cap_source_url: str = None, cap_data: xml = None) -> None:
+    def addAlert(self, cap_source_url: str = None, cap_data: xml = None,
+                 cap_element: ET.Element = None) -> str | None:
         """
         parse the alert and store it in the database
         :param cap_source_url: the url of the cap source
         :param cap_data: the xml data of the cap alert
-        :return: None
+        :param cap_element: the already parsed xml element of the cap alert, used instead of cap_data for alerts
+        embedded in the feed itself. The element might be modified.
+        :return: the id of the alert if it is stored or unchanged, None if the alert was skipped
         :warns: if the alert can not be parsed correctly we raise a warning
         """
         try:
-            if not cap_data:
-                logger.info(f"{self.feed_source.source_id} - Got no CAP alert message, skipping")
-                return
-
-            cap_data_modified: bool = False
-            # crude way to normalize to CAP v1.2, US NWS still uses v1.1 data
-            # @todo should not be necessary anymore it seems that they also use 1.2 now
-            if 'urn:oasis:names:tc:emergency:cap:1.1' in cap_data:
-                cap_data = cap_data.replace('urn:oasis:names:tc:emergency:cap:1.1',
-                                            'urn:oasis:names:tc:emergency:cap:1.2')
-                cap_data_modified = True
-
-            cap_msg = cap.CAPAlertMessage.from_string(cap_data)
+            if cap_element is not None:
+                # the known alert check below is cheap as the element is parsed already
+                cap_data_modified: bool = cap.CAPAlertMessage.normalize_namespace(cap_element)
+                cap_msg = cap.CAPAlertMessage.from_element(cap_element)
+            else:
+                if not cap_data:
+                    logger.info(f"{self.feed_source.source_id} - Got no CAP alert message, skipping")
+                    return
+
+                # check if we already know the alert before parsing and processing the entire message
+                alert_id, sent_time = cap.CAPAlertMessage.peek_identifier_and_sent_time(cap_data)
+                if self.is_known_alert(alert_id, sent_time):
+                    self.record_unchanged_alert(alert_id)
+                    return alert_id
+
+                cap_data_modified: bool = False
+                # crude way to normalize to CAP v1.2, US NWS still uses v1.1 data
+                # @todo should not be necessary anymore it seems that they also use 1.2 now
+                if 'urn:oasis:names:tc:emergency:cap:1.1' in cap_data:
+                    cap_data = cap_data.replace('urn:oasis:names:tc:emergency:cap:1.1',
+                                                'urn:oasis:names:tc:emergency:cap:1.2')
+                    cap_data_modified = True
+
+                cap_msg = cap.CAPAlertMessage.from_string(cap_data)
             if cap_msg.is_expired():
                 return
             if cap_msg.scope() == "Private":
@@ -276,19 +390,26 @@ class AbstractCAPParser(ABC):
 
             # if we already know the alert and it's sent time matches we assume nothing changed
             # if the sent time did change we got an update
-            if len(Alert.objects.filter(source_id=self.feed_source.source_id, alert_id=alert_id, issue_time=sent_time)) == 1:
+            if self.is_known_alert(alert_id, sent_time):
                 self.record_unchanged_alert(alert_id)
-                return
+                return alert_id
 
             # find expire time
             expire_time = cap_msg.expire_time()
 
+            # the geometry given directly in the CAP data, before adding the polygons of expanded geocodes
+            cap_polygons = cap_msg.polygons()
+            cap_circles = cap_msg.circles()
+
             # expand geocodes if necessary
-            cap_data_modified |= self.expand_geocode(cap_msg.xml)
+            # the polygons are added to the CAP data for clients, the area is taken from the geocode store directly
+            expanded_geocodes = []
+            cap_data_modified |= self.expand_geocode(cap_msg.xml, expanded_geocodes)
 
             cap_data = cap_msg.to_string()
 
-            polygon = cap_geometry.multipolygon_from_cap_alert(cap_msg)
+            geocode_areas = [geocode_store.area(expanded_geocodes)] if expanded_geocodes else []
+            polygon = cap_geometry.multipolygon_from_cap_areas(cap_polygons, cap_circles, geocode_areas)
             if polygon.empty or not polygon.valid:
                 raise NoGeographicDataAvailableException(f"No geographic data available for {alert_id}")
 
@@ -334,7 +455,12 @@ class AbstractCAPParser(ABC):
             self.list_of_current_alert_ids.append(new_alert.alert_id)
             # write alert to database
             self.write_to_database_and_send_notification(new_alert)
+            self.known_alerts[alert_id] = sent_time
+            self.alerts_changed += 1
+            return alert_id
         except DatabaseWritingException as e:
+            # process the feed again next time, even if it didn't change, to retry storing this alert
+            self.fetch_complete = False
             warnings.warn(f"Database error: {str(e)} - skipping")
             logger.exception(f"Database error: {str(e)} - skipping")
         except AlertExpiredException as e:
@@ -348,6 +474,20 @@ class AbstractCAPParser(ABC):
             #warnings.warn(f"Unknown geometry code:[{self.feed_source.source_id}] - {str(e)} - skipping")
             logger.exception(f"Unknown geometry code:[{self.feed_source.source_id}]- skipping", exc_info=e)
 
+    def is_known_alert(self, alert_id: str, sent_time: datetime) -> bool:
+        """
+        check if we already have the given alert with the same sent time, i.e. the alert is unchanged
+        only valid during get_feed, which loads the known alerts of the source
+        :param alert_id: the identifier of the alert
+        :param sent_time: the sent time of the alert, naive datetimes are interpreted as UTC
+        :return: true if the alert is known and unchanged, false if it is new or an update
+        """
+        if alert_id is None or sent_time is None:
+            return False
+        if sent_time.tzinfo is None:
+            sent_time = sent_time.replace(tzinfo=timezone.utc)
+        return self.known_alerts.get(alert_id) == sent_time
+
     def record_unchanged_alert(self, alert_id: str):
         """
         Record a still active but unchanged alert as part of a fetch.
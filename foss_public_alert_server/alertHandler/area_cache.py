@@ -0,0 +1,86 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import math
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import FloatField, Func
+
+ALERT_GENERATION_CACHE_KEY = "alert-generation"
+# the extent of an alert's area, computed by the database to not load and parse the geometries
+AREA_EXTENT_FIELDS = {f'area_{name}': Func('area', function=f'ST_{name}', output_field=FloatField())
+                      for name in ('XMin', 'YMin', 'XMax', 'YMax')}
+
+
+def get_alert_generation() -> str:
+    """
+    get the current alert generation. The generation changes whenever alerts are added, updated or deleted,
+    so everything derived from the set of active alerts can be cached per generation.
+    :return: the current generation
+    """
+    generation = cache.get(ALERT_GENERATION_CACHE_KEY)
+    if generation is None:
+        generation = bump_alert_generation()
+    return generation
+
+
+def bump_alert_generation() -> str:
+    """
+    start a new alert generation, has to be called after every change of the alerts in the database.
+    The generation is a random token rather than an incremented number, that way concurrent changes from
+    different worker processes can't end up with the same generation.
+    :return: the new generation
+    """
+    generation = uuid.uuid4().hex
+    cache.set(ALERT_GENERATION_CACHE_KEY, generation, timeout=None)
+    return generation
+
+
+def snap_bbox(x1: float, y1: float, x2: float, y2: float) -> (float, float, float, float):
+    """
+    extend the given bounding box outwards to the grid of settings.ALERT_AREA_CACHE_GRID
+    so that overlapping requests share the same cache entries
+    :return: the snapped bounding box as (min lon, min lat, max lon, max lat)
+    """
+    grid = settings.ALERT_AREA_CACHE_GRID
+    return (max(-180.0, math.floor(min(x1, x2) / grid) * grid),
+            max(-90.0, math.floor(min(y1, y2) / grid) * grid),
+            min(180.0, math.ceil(max(x1, x2) / grid) * grid),
+            min(90.0, math.ceil(max(y1, y2) / grid) * grid))
+
+
+def normalize_bbox(x1: float, y1: float, x2: float, y2: float) -> (float, float, float, float):
+    """
+    :return: the given bounding box as (min lon, min lat, max lon, max lat)
+    """
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def split_by_extent(alerts: list, bbox: (float, float, float, float)) -> (list, list):
+    """
+    match the alerts of a snapped bounding box against the exact bounding box of a request using their extents
+    :param alerts: list of (alert id, min lon, min lat, max lon, max lat) of the alerts
+    :param bbox: the requested bounding box as (min lon, min lat, max lon, max lat)
+    :return: the ids of the alerts whose extent lies within the bounding box, so they intersect it, and the ids of
+    the alerts whose extent overlaps the bounding box only partially and need an exact intersects test
+    """
+    inside = []
+    overlapping = []
+    for alert_id, min_x, min_y, max_x, max_y in alerts:
+        if min_x > bbox[2] or max_x < bbox[0] or min_y > bbox[3] or max_y < bbox[1]:
+            continue
+        if min_x >= bbox[0] and max_x <= bbox[2] and min_y >= bbox[1] and max_y <= bbox[3]:
+            inside.append(alert_id)
+        else:
+            overlapping.append(alert_id)
+    return inside, overlapping
+
+
+def area_cache_key(generation: str, bbox: (float, float, float, float)) -> str:
+    """
+    get the cache key of the alert list for a snapped bounding box. For the exact bounding box of a request it is used
+    as ETag of the response
+    """
+    return f"alert-area:{generation}:" + ":".join(f"{round(coord, 6):g}" for coord in bbox)
@@ -3,18 +3,14 @@
 # SPDX-FileCopyrightText: Volker Krause <vkrause@kde.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import requests
+import io
 import logging
 import xml.etree.ElementTree as ET
 
 from dateutil import parser
 
-from django.http import HttpResponseNotModified
-from django.conf import settings
-
-from .exceptions import NothingChangedException
 from .abstract_CAP_parser import AbstractCAPParser
-from sourceFeedHandler.models import CAPFeedSource
+from lib import cap
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,27 +25,9 @@ class EmbeddedCAPParser(AbstractCAPParser):
 
     def _load_alerts_from_feed(self):
         logger.info(f"fetching: {self.feed_source.source_id}")
-        # use etags to reduce network load
-        last_e_tag = self.feed_source.last_e_tag
-        response: requests.Response
-        feed: ET.Element
-
-        if last_e_tag is not None:
-            response: requests.Response = requests.get(self.feed_source.cap_alert_feed, headers={'If-None-Match': last_e_tag, 'User-Agent': settings.USER_AGENT})
-        else:
-            response: requests.Response = requests.get(self.feed_source.cap_alert_feed)
-
-        if response.status_code == HttpResponseNotModified.status_code:
-            raise NothingChangedException("Nothing changed")
-
-        # check if header has en etag and if yes update the etag in the database
-        if "etag" in response.headers:
-            new_etag = response.headers["etag"]
-            CAPFeedSource.objects.filter(id=self.feed_source.id).update(last_e_tag=new_etag)
-
-        feed: ET.Element = ET.fromstring(response.text)
-        for entry in feed.findall('{http://www.w3.org/2005/Atom}entry'):
-            alert_xml = entry.find('{http://www.w3.org/2005/Atom}content')[0]
-            cap_data = ET.tostring(alert_xml, 'unicode')
+        response = self.fetch_feed()
+
+        # parse the feed incrementally, each CAP alert is processed and released as soon as it is read
+        for alert_xml in cap.CAPAlertMessage.iter_alert_elements(io.BytesIO(response.content)):
             # add alert to database
-            self.addAlert(cap_data=cap_data)
+            self.addAlert(cap_element=alert_xml)
@@ -0,0 +1,221 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-FileCopyrightText: Volker Krause <vkrause@kde.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon
+
+from lib import cap_geometry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class GeocodeStoreUnavailableException(Exception):
+    """
+    Internal. The geocode store hasn't been built (yet), lookups must not be cached then.
+    """
+    pass
+
+
+class GeocodeStore:
+    """
+    Indexed store of the GeoJSON geometries of all geocodes in alertHandler/data/<code name>/<code value>.geojson.
+
+    The geometries are indexed into a SQLite database once by build(), run by the build_geocode_store management
+    command on deployment. Lookups only read from that database by primary key without touching the GeoJSON files,
+    and recently decoded geometries are kept in an LRU cache shared by all parsers of the worker process.
+    Nothing is cached while the database is missing, e.g. while it is still built on startup.
+    The returned GeoJSON objects are shared and must not be modified.
+    """
+
+    def __init__(self, data_dir: str, db_path: str, cache_size: int, area_cache_size: int):
+        self.data_dir = data_dir
+        self.db_path = db_path
+        # read-only connections of the feed threads
+        self._local = threading.local()
+        self._get = functools.lru_cache(maxsize=cache_size)(self._load)
+        self._area = functools.lru_cache(maxsize=area_cache_size)(self._load_area)
+
+    def clear(self) -> None:
+        """
+        Drop the cached geometries and areas and the database connection of this thread, e.g. after a rebuild.
+        """
+        self._get.cache_clear()
+        self._area.cache_clear()
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _get_connection(self) -> sqlite3.Connection | None:
+        """
+        Internal. Open the database read-only and lazily per thread, worker processes must not share the connection
+        of their parent.
+        :return: None if the store hasn't been built
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            try:
+                connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=60)
+            except sqlite3.OperationalError as e:
+                logger.error(f"Can't open the geocode store {self.db_path}, run manage.py build_geocode_store: {e}")
+                return None
+            self._local.connection = connection
+        return connection
+
+    def _directory_signature(self, code_dir: str) -> str:
+        """
+        Internal. Summarize the state of a geocode directory to detect changes of the GeoJSON files.
+        """
+        count = 0
+        latest_mtime = 0
+        with os.scandir(code_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.geojson'):
+                    count += 1
+                    latest_mtime = max(latest_mtime, entry.stat().st_mtime_ns)
+        return f"{count}:{latest_mtime}"
+
+    def build(self, code_names: list = None) -> None:
+        """
+        Index the GeoJSON files into the database, code names whose files didn't change since the last build are
+        skipped. This is meant to run once on deployment, not while feeds are processed.
+        :param code_names: the code names to index, all code names in the data directory if None
+        :return: None
+        """
+        if code_names is None:
+            code_names = sorted(entry.name for entry in os.scandir(self.data_dir) if entry.is_dir())
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS code_names "
+                               "(code_name TEXT PRIMARY KEY, signature TEXT NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS geocodes "
+                               "(code_name TEXT NOT NULL, code_value TEXT NOT NULL, geojson BLOB NOT NULL, "
+                               "PRIMARY KEY (code_name, code_value)) WITHOUT ROWID")
+            for code_name in code_names:
+                self._build_code_name(connection, code_name)
+        finally:
+            connection.close()
+
+    def _build_code_name(self, connection: sqlite3.Connection, code_name: str) -> None:
+        """
+        Internal. Index the geometries of the given code name, if they changed since the last build.
+        """
+        code_dir = os.path.join(self.data_dir, code_name)
+        signature = self._directory_signature(code_dir)
+        row = connection.execute("SELECT signature FROM code_names WHERE code_name = ?", (code_name,)).fetchone()
+        if row is not None and row[0] == signature:
+            return
+
+        logger.info(f"Indexing geocodes of {code_name}")
+        connection.execute("BEGIN")
+        try:
+            connection.execute("DELETE FROM geocodes WHERE code_name = ?", (code_name,))
+            with os.scandir(code_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.geojson'):
+                        continue
+                    with open(entry.path, 'rb') as f:
+                        geojson = zlib.compress(f.read())
+                    connection.execute("INSERT INTO geocodes (code_name, code_value, geojson) VALUES (?, ?, ?)",
+                                       (code_name, entry.name.removesuffix('.geojson'), geojson))
+            connection.execute("INSERT OR REPLACE INTO code_names (code_name, signature) VALUES (?, ?)",
+                               (code_name, signature))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _load(self, code_name: str, code_value: str) -> dict | None:
+        """
+        Internal. Load and decode the GeoJSON feature of the given geocode, use get() for cached access.
+        :raise GeocodeStoreUnavailableException: if the store can't be read
+        """
+        connection = self._get_connection()
+        if connection is None:
+            raise GeocodeStoreUnavailableException()
+        try:
+            row = connection.execute("SELECT geojson FROM geocodes WHERE code_name = ? AND code_value = ?",
+                                     (code_name, code_value)).fetchone()
+        except sqlite3.OperationalError as e:
+            logger.error(f"Failed to read the geocode store, run manage.py build_geocode_store: {e}")
+            raise GeocodeStoreUnavailableException() from e
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def get(self, code_name: str, code_value: str) -> dict | None:
+        """
+        Get the GeoJSON feature of the given geocode, None if it is unknown or the store is not available.
+        """
+        try:
+            return self._get(code_name, code_value)
+        except GeocodeStoreUnavailableException:
+            return None
+
+    def _lookup(self, code_name: str, code_value: str) -> dict | None:
+        """
+        Internal. lookup() without handling an unavailable store.
+        """
+        geojson = self._get(code_name, code_value)
+        if geojson is not None:
+            return geojson
+
+        # for hierarchical CPEAS codes check if we have a parent code at least
+        if code_name == "CPEAS Geographic Code":
+            for i in range(0, 3):
+                parent_code = code_value[0:6 - i*2] + '0000000000'[4-i*2:]
+                if parent_code != code_value:
+                    return self._lookup(code_name, parent_code)
+
+        return None
+
+    def lookup(self, code_name: str, code_value: str) -> dict | None:
+        """
+        Get the GeoJSON feature for a given CAP geo code, falling back to parent codes for hierarchical codes.
+        Returns None if not found.
+        """
+        try:
+            return self._lookup(code_name, code_value)
+        except GeocodeStoreUnavailableException:
+            return None
+
+    def _load_area(self, geocodes: frozenset) -> MultiPolygon:
+        """
+        Internal. Compute the united area of the given geocodes, use area() for cached access.
+        """
+        polys = []
+        for code_name, code_value in geocodes:
+            geojson = self._lookup(code_name, code_value)
+            if geojson is not None:
+                polys += cap_geometry.polygons_from_geojson_feature(geojson)
+        return cap_geometry.multipolygon_from_cap_areas([], [], polys)
+
+    def area(self, geocodes) -> MultiPolygon:
+        """
+        Get the area covered by the given geocodes as GEOS MultiPolygon.
+        The result is cached per set of geocodes, so alerts for the same regions don't need to compute it again.
+        :param geocodes: iterable of (code name, code value) tuples
+        :return: a new MultiPolygon the caller is free to modify, empty if the store is not available
+        """
+        try:
+            return self._area(frozenset(geocodes)).clone()
+        except GeocodeStoreUnavailableException:
+            return MultiPolygon()
+
+
+# the store shared by all parsers of this process
+geocode_store = GeocodeStore(os.path.join(settings.BASE_DIR, 'alertHandler/data'),
+                             settings.GEOCODE_STORE_PATH,
+                             settings.GEOCODE_STORE_CACHE_SIZE,
+                             settings.GEOCODE_AREA_CACHE_SIZE)
@@ -0,0 +1,51 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import threading
+
+import requests_cache
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# how long responses are kept in the HTTP cache. The parsers fetch everything via AbstractCAPParser.fetch, which
+# revalidates the stored copy on every use, so this only limits how long unused entries are kept
+HTTP_CACHE_EXPIRY = 60 * 60 * 24
+
+_adapter: HTTPAdapter = None
+_session: requests_cache.CachedSession = None
+_lock = threading.Lock()
+
+
+def get_http_adapter() -> HTTPAdapter:
+    """
+    get the process wide transport adapter used by all parsers to fetch feeds and CAP messages.
+    The adapter keeps a pool of keep-alive connections for every server, so feeds hosted on the same server and
+    consecutive fetches of the same feed don't need a new TCP and TLS handshake each.
+    The adapter is created lazily to not share connections between forked worker processes.
+    :return: the shared adapter
+    """
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_connections=settings.FEED_HTTP_POOL_HOSTS,
+                                   pool_maxsize=settings.FEED_HTTP_POOL_SIZE)
+        return _adapter
+
+
+def get_cached_session() -> requests_cache.CachedSession:
+    """
+    get the process wide caching HTTP session used by all parsers.
+    All feeds share a single SQLite cache, opened once per process. Expired entries are removed by the periodic
+    remove_expired_http_cache_entries task rather than on every use.
+    :return: the shared session
+    """
+    global _session
+    adapter = get_http_adapter()
+    with _lock:
+        if _session is None:
+            _session = requests_cache.CachedSession(cache_name=str(settings.FEED_HTTP_CACHE_PATH),
+                                                    backend='sqlite', wal=True,
+                                                    expire_after=HTTP_CACHE_EXPIRY)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
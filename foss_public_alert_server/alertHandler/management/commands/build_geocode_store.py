@@ -0,0 +1,16 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from django.core.management.base import BaseCommand
+
+from alertHandler.geocode_store import geocode_store
+
+
+class Command(BaseCommand):
+    help = "Index the geocode geometries in alertHandler/data into the geocode store, unchanged ones are skipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('code_names', nargs='*', help="only index these code names")
+
+    def handle(self, *args, **options):
+        geocode_store.build(options['code_names'] or None)
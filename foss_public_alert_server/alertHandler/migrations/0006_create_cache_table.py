@@ -0,0 +1,19 @@
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    # the area endpoint, the feed parsers and the push notification workers rely on the database cache,
+    # so create its table with every migrate instead of depending on a separate createcachetable step
+    call_command('createcachetable', database=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alertHandler', '0005_remove_alert_bounding_box_alter_alert_area_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_tables(apps, schema_editor):
+    # the alert lists of the area endpoint got their own cache, create its table on databases migrated before.
+    # createcachetable skips the tables that exist already
+    call_command('createcachetable', database=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alertHandler', '0006_create_cache_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_tables, migrations.RunPython.noop),
+    ]
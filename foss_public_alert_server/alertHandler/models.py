@@ -8,6 +8,8 @@ from django.contrib.gis.db import models
 import os
 import uuid
 
+from .area_cache import bump_alert_generation
+
 
 # Create your models here.
 
@@ -23,6 +25,30 @@ def alert_upload_path(instance, filename) -> str:
     return f"alerts/{instance.source_id}/{filename}"
 
 
+class AlertQuerySet(models.QuerySet):
+
+    def delete_with_cap_data(self) -> int:
+        """
+        delete all alerts of this queryset with a single DELETE statement and remove their stored cap data afterwards.
+        Unlike delete() this neither loads the alerts nor sends the post_delete signal for every alert.
+        :return: the number of deleted alerts
+        """
+        cap_data_files = list(self.exclude(cap_data='').values_list('cap_data', flat=True))
+        # delete() would load every alert to send post_delete, so use the private _raw_delete instead. That skips
+        # signals and cascades, which is safe here: no other model references Alert, and the two things the
+        # post_delete receiver does, bumping the alert generation and removing the cap data, are done right here.
+        # Keep this in sync with auto_delete_capdata_on_delete and check it when adding relations to Alert.
+        deleted = self._raw_delete(self.db)
+        if deleted:
+            bump_alert_generation()
+
+        storage = self.model._meta.get_field('cap_data').storage
+        for name in cap_data_files:
+            if name:
+                storage.delete(name)
+        return deleted
+
+
 class Alert(models.Model):
     """
     - id: unique id of the alert in database
@@ -53,6 +79,8 @@ class Alert(models.Model):
     urgency = models.CharField(max_length=255, null=True)
     area = models.MultiPolygonField(spatial_index=True)
 
+    objects = AlertQuerySet.as_manager()
+
     class Meta:
         constraints = [models.UniqueConstraint('source_id', 'alert_id', name='source_id-alert_id-unique')]
 
@@ -72,11 +100,12 @@ class Alert(models.Model):
 @receiver(models.signals.post_delete, sender=Alert)
 def auto_delete_capdata_on_delete(sender, instance:Alert, **kwargs) -> None:
     """
-    called if Alert entry is deleted. Deletes also the locally stored cap data
+    called if Alert entry is deleted. Deletes also the locally stored cap data and invalidates cached alert lists
     :param instance: The actual instance being deleted.
     :param kwargs:
     :return: None
     """
+    bump_alert_generation()
     if instance.cap_data:
         if os.path.isfile(instance.cap_data.path):
             os.remove(instance.cap_data.path)
@@ -11,6 +11,7 @@ from celery import shared_task
 from .XML_CAP_parser import XMLCAPParser
 from .DWD_CAP_parser import DWDCAPParser
 from .models import Alert
+from .http_session import get_cached_session
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,14 +36,21 @@ def check_if_alert_is_expired(expire_time:datetime) -> bool:
 @shared_task(name="task.remove_expired_alerts")
 def remove_expired_alerts() -> bool:
     """
-    check for every alert if it is expired and delete every expired alert
+    delete every expired alert and its stored cap data
     called by a periodic celery task
     :return:
     """
-    for alert in Alert.objects.all():
-        if check_if_alert_is_expired(alert.expire_time):
-            logger.info(f"delete alert {alert.alert_id}")
-            Alert.objects.filter(id=alert.id).delete()
-            # the delete() sends also a signal to a class methode (Alert.auto_delete_capdata_on_delete)
-            # to also delete the stored cap data
+    deleted = Alert.objects.filter(expire_time__lt=datetime.datetime.now(datetime.timezone.utc)).delete_with_cap_data()
+    logger.info(f"deleted {deleted} expired alerts")
+    return True
+
+
+@shared_task(name="task.remove_expired_http_cache_entries")
+def remove_expired_http_cache_entries() -> bool:
+    """
+    delete expired and invalid responses from the HTTP cache of the feed parsers
+    called by a periodic celery task
+    :return:
+    """
+    get_cached_session().cache.delete(expired=True, invalid=True, vacuum=False)
     return True
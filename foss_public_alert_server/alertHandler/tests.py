@@ -1,17 +1,24 @@
 # SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
 import os
 import logging
+import tempfile
 from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
 from django.conf import settings
+from django.core.cache import caches
 from django.test import TestCase
 from sourceFeedHandler.models import CAPFeedSource
 
-from .exceptions import AlertExpiredException
+from .exceptions import AlertExpiredException, DatabaseWritingException, NothingChangedException
 from .models import Alert
 from .abstract_CAP_parser import AbstractCAPParser
+from .geocode_store import geocode_store
 from .XML_CAP_parser import XMLCAPParser
+from .NINA_CAP_parser import NinaCapParser
+from .tasks import remove_expired_alerts
 import xml.etree.ElementTree as ET
 
 from lib import cap_geojson
@@ -22,6 +29,19 @@ logger = logging.getLogger(__name__)
 
 class AlertHandlerCAPParserTestsCase(TestCase):
 
+    def setUp(self):
+        # build the geocode store in a temporary directory instead of overwriting the deployed one
+        self.geocode_store_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.geocode_store_dir.name, 'geocodes.sqlite')
+        self.geocode_store_path = patch.object(geocode_store, 'db_path', db_path)
+        self.geocode_store_path.start()
+        geocode_store.clear()
+
+    def tearDown(self):
+        geocode_store.clear()
+        self.geocode_store_path.stop()
+        self.geocode_store_dir.cleanup()
+
     @staticmethod
     def create_test_class_instance() -> AbstractCAPParser:
         feed = CAPFeedSource(
@@ -72,6 +92,7 @@ class AlertHandlerCAPParserTestsCase(TestCase):
         self.assertEqual(expand_geocode, False)
 
     def test_expand_geocode_without_polygon(self):
+        geocode_store.build(['EMMA_ID'])
         cap_data = self.create_test_cap_data('test_cap_data_without_polygon_EMMA_ID_AT001.xml')
         abstract_cap_parser = self.create_test_class_instance()
         ET.register_namespace('', 'urn:oasis:names:tc:emergency:cap:1.2')
@@ -161,3 +182,145 @@ class AlertHandlerCAPParserTestsCase(TestCase):
 
         abstract_cap_parser.addAlert()
         self.assertEqual(Alert.objects.count(), 0)
+
+    def test_remove_expired_alerts(self):
+        cap_data = self.create_test_cap_data('test_cap_data_1.xml')
+        abstract_cap_parser, cap_tree = self.create_test_xml_tree(cap_data)
+        abstract_cap_parser.addAlert(cap_data=cap_data, cap_source_url="https://OnlyForTesting.de")
+        self.assertEqual(Alert.objects.count(), 1)
+        cap_data_path = Alert.objects.first().cap_data.path
+        self.assertTrue(os.path.isfile(cap_data_path))
+
+        # not expired yet
+        remove_expired_alerts()
+        self.assertEqual(Alert.objects.count(), 1)
+
+        Alert.objects.update(expire_time=datetime(2024, 4, 22, tzinfo=timezone.utc))
+        remove_expired_alerts()
+        self.assertEqual(Alert.objects.count(), 0)
+        self.assertFalse(os.path.isfile(cap_data_path))
+
+    def test_is_known_alert(self):
+        cap_data = self.create_test_cap_data('test_cap_data_1.xml')
+        abstract_cap_parser, cap_tree = self.create_test_xml_tree(cap_data)
+        abstract_cap_parser.addAlert(cap_data=cap_data, cap_source_url="https://OnlyForTesting.de")
+
+        abstract_cap_parser = self.create_test_class_instance()
+        abstract_cap_parser.known_alerts = dict(Alert.objects.values_list('alert_id', 'issue_time'))
+        self.assertTrue(abstract_cap_parser.is_known_alert("urn:oid:1234.5678",
+                                                           datetime.fromisoformat("2024-04-21T11:51:29-03:00")))
+        self.assertTrue(abstract_cap_parser.is_known_alert("urn:oid:1234.5678",
+                                                           datetime.fromisoformat("2024-04-21T14:51:29")))
+        self.assertFalse(abstract_cap_parser.is_known_alert("urn:oid:1234.5678",
+                                                            datetime.fromisoformat("2024-04-21T12:51:29-03:00")))
+        self.assertFalse(abstract_cap_parser.is_known_alert("urn:oid:0000", None))
+
+    def test_get_alerts_for_area(self):
+        cap_data = self.create_test_cap_data('test_cap_data_1.xml')
+        abstract_cap_parser, cap_tree = self.create_test_xml_tree(cap_data)
+        abstract_cap_parser.addAlert(cap_data=cap_data, cap_source_url="https://OnlyForTesting.de")
+        alert = Alert.objects.first()
+
+        response = self.client.get('/alert/area?min_lat=50&max_lat=51&min_lon=7&max_lon=8')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.getvalue()), [str(alert.id)])
+        etag = response['ETag']
+
+        response = self.client.get('/alert/area?min_lat=10&max_lat=11&min_lon=7&max_lon=8')
+        self.assertEqual(json.loads(response.getvalue()), [])
+
+        # overlapping requests in the same grid cell are served from the cache, for their exact bounding box
+        response = self.client.get('/alert/area?min_lat=50.2&max_lat=50.8&min_lon=7.1&max_lon=7.9')
+        self.assertEqual(json.loads(response.getvalue()), [str(alert.id)])
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get('/alert/area?min_lat=50&max_lat=51&min_lon=7&max_lon=8', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # changing the alerts invalidates the cached responses
+        Alert.objects.update(expire_time=datetime(2024, 4, 22, tzinfo=timezone.utc))
+        remove_expired_alerts()
+        response = self.client.get('/alert/area?min_lat=50&max_lat=51&min_lon=7&max_lon=8', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.getvalue()), [])
+
+    def test_alert_area_cache(self):
+        response = self.client.get('/alert/area?min_lat=50&max_lat=51&min_lon=7&max_lon=8')
+        self.assertEqual(json.loads(response.getvalue()), [])
+        # the bounding box is aligned to the grid, so the ETag is the cache key of its cell
+        cache_key = response['ETag'].strip('"')
+        self.assertEqual(caches['alert_areas'].get(cache_key), [])
+
+        # further requests are answered from the cache table without querying the alerts
+        # and only get the alerts within their exact bounding box
+        caches['alert_areas'].set(cache_key, [("inside", 7.1, 50.6, 7.2, 50.7), ("outside", 7.8, 50.1, 7.9, 50.2)])
+        response = self.client.get('/alert/area?min_lat=50.5&max_lat=51&min_lon=7&max_lon=7.5')
+        self.assertEqual(json.loads(response.content), ["inside"])
+
+    def test_check_feed_content(self):
+        abstract_cap_parser = self.create_test_class_instance()
+        abstract_cap_parser.check_feed_content(b'<feed/>')
+        abstract_cap_parser.feed_source.last_content_hash = abstract_cap_parser.feed_content_hash
+
+        with self.assertRaises(NothingChangedException):
+            abstract_cap_parser.check_feed_content(b'<feed/>')
+        abstract_cap_parser.check_feed_content(b'<feed></feed>')
+        self.assertNotEqual(abstract_cap_parser.feed_content_hash, abstract_cap_parser.feed_source.last_content_hash)
+
+    def test_fetch_feed_unchanged(self):
+        abstract_cap_parser = self.create_test_class_instance()
+        response = MagicMock(from_cache=True, headers={})
+
+        # an unchanged feed is processed again if not all alerts could be stored last time
+        with patch.object(abstract_cap_parser, 'fetch', return_value=response):
+            self.assertIs(abstract_cap_parser.fetch_feed(), response)
+            abstract_cap_parser.feed_source.last_content_hash = "hash"
+            with self.assertRaises(NothingChangedException):
+                abstract_cap_parser.fetch_feed()
+
+    def test_get_feed_failed_alert_is_retried(self):
+        cap_data = self.create_test_cap_data('test_cap_data_1.xml')
+        abstract_cap_parser = self.create_test_class_instance()
+        abstract_cap_parser.feed_source.save()
+
+        def load_alerts():
+            abstract_cap_parser.check_feed_content(cap_data.encode())
+            abstract_cap_parser.addAlert(cap_data=cap_data)
+
+        with patch.object(abstract_cap_parser, '_load_alerts_from_feed', load_alerts):
+            with patch.object(AbstractCAPParser, 'write_to_database_and_send_notification',
+                              side_effect=DatabaseWritingException("test")):
+                abstract_cap_parser.get_feed(abstract_cap_parser)
+            self.assertFalse(abstract_cap_parser.fetch_complete)
+            abstract_cap_parser.feed_source.refresh_from_db()
+            self.assertIsNone(abstract_cap_parser.feed_source.last_content_hash)
+            self.assertEqual(Alert.objects.count(), 0)
+
+            # the unchanged feed is not skipped the next time and the alert is stored
+            abstract_cap_parser.get_feed(abstract_cap_parser)
+            self.assertTrue(abstract_cap_parser.fetch_complete)
+            abstract_cap_parser.feed_source.refresh_from_db()
+            self.assertEqual(abstract_cap_parser.feed_source.last_content_hash, abstract_cap_parser.feed_content_hash)
+            self.assertEqual(Alert.objects.count(), 1)
+
+    def test_geocode_store_missing(self):
+        # lookups are not cached while the store is still being built
+        self.assertIsNone(geocode_store.lookup('EMMA_ID', 'AT001'))
+        self.assertTrue(geocode_store.area([('EMMA_ID', 'AT001')]).empty)
+        geocode_store.build(['EMMA_ID'])
+        self.assertIsNotNone(geocode_store.lookup('EMMA_ID', 'AT001'))
+        self.assertFalse(geocode_store.area([('EMMA_ID', 'AT001')]).empty)
+
+    def test_nina_unchanged_alert(self):
+        parser = NinaCapParser(self.create_test_class_instance().feed_source)
+        parser.known_alerts = {"DE-cap-identifier": datetime.now(timezone.utc)}
+        parser.list_of_current_alert_ids = []
+        response = MagicMock(content=b'[{"id": "mow.json-id"}]')
+        with patch.object(parser, 'fetch_feed', return_value=response), \
+                patch.object(parser, 'get_json', return_value=({"identifier": "DE-cap-identifier"}, True)), \
+                patch.object(parser, 'addAlert') as add_alert:
+            parser._load_alerts_from_feed()
+        # unchanged alerts are matched by their CAP identifier, not by the id of the JSON API
+        add_alert.assert_not_called()
+        self.assertEqual(parser.list_of_current_alert_ids, ["DE-cap-identifier"])
@@ -3,15 +3,20 @@
 
 import logging
 
+from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.http.request import HttpRequest
 from django.shortcuts import render
 
-from django.http import (HttpResponseBadRequest, HttpResponseNotFound,
-                         HttpResponsePermanentRedirect, JsonResponse)
+from django.http import (HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified,
+                         HttpResponsePermanentRedirect, JsonResponse, StreamingHttpResponse)
 from django.contrib.gis.geos import Polygon
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.http import require_http_methods
 
+from .area_cache import AREA_EXTENT_FIELDS, get_alert_generation, snap_bbox, normalize_bbox, split_by_extent, \
+    area_cache_key
 from .models import Alert
 from subscriptionHandler.models import Subscription # has to be so because of django
 
@@ -53,16 +58,15 @@ def get_alerts_for_subscription_id(request):
         return HttpResponseBadRequest("no valid subscription")
 
     # filter and return all alerts which intersects with the subscribed polygone
-    result = []
-    for alert in Alert.objects.filter(area__intersects=polygon):
-        result.append(str(alert.id))
-
-    return JsonResponse(result, safe=False)
+    return stream_alert_ids(Alert.objects.filter(area__intersects=polygon))
 
 @require_http_methods(["GET"])
 def get_alerts_for_area(request):
     """
     get all alerts for the given area
+    The ids and extents of the alerts in the bounding box extended to the cache grid are cached until the alerts
+    change, so overlapping requests share them. They are matched against the exact bounding box of the request,
+    only alerts whose extent overlaps it partially need an intersects query.
     :param request:
     :return:
     """
@@ -73,16 +77,51 @@ def get_alerts_for_area(request):
         x2 = float(request.GET.get('max_lon'))
         if not isValidBbox(x1, y1, x2, y2):
             return HttpResponseBadRequest('invalid bounding box')
-        request_bbox = Polygon.from_bbox((x1, y1, x2, y2))
-
-        res = []
-        for alert in Alert.objects.filter(area__intersects=request_bbox):
-            res.append(str(alert.id))
-        return JsonResponse(res, safe=False)
+        bbox = normalize_bbox(x1, y1, x2, y2)
+        generation = get_alert_generation()
+        etag = quote_etag(area_cache_key(generation, bbox))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return HttpResponseNotModified(headers={'ETag': etag})
+
+        cell = snap_bbox(*bbox)
+        cache_key = area_cache_key(generation, cell)
+        alerts = caches['alert_areas'].get(cache_key)
+        if alerts is None:
+            alerts = [(str(alert_id), *extent) for alert_id, *extent in
+                      Alert.objects.filter(area__intersects=Polygon.from_bbox(cell)).annotate(**AREA_EXTENT_FIELDS)
+                      .values_list('id', *AREA_EXTENT_FIELDS)]
+            caches['alert_areas'].set(cache_key, alerts, timeout=settings.ALERT_AREA_CACHE_TIMEOUT)
+
+        inside, overlapping = split_by_extent(alerts, bbox)
+        inside = set(inside)
+        if overlapping:
+            inside.update(str(alert_id) for alert_id in
+                          Alert.objects.filter(id__in=overlapping, area__intersects=Polygon.from_bbox(bbox))
+                          .values_list('id', flat=True))
+        result = [alert[0] for alert in alerts if alert[0] in inside]
+        return JsonResponse(result, safe=False, headers={'ETag': etag})
     except (ValueError, TypeError):
         return HttpResponseBadRequest('invalid bounding box')
 
 
+def stream_alert_ids(alerts) -> StreamingHttpResponse:
+    """
+    stream the ids of the given alerts as JSON list
+    only the ids are selected, so the alert areas are neither transferred from the database nor parsed
+    :param alerts: queryset of the alerts
+    :return: a streaming JSON response
+    """
+    def generate():
+        yield '['
+        separator = ''
+        for alert_id in alerts.values_list('id', flat=True).iterator():
+            yield f'{separator}"{alert_id}"'
+            separator = ', '
+        yield ']'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+
 def isValidBbox(x1, y1, x2, y2):
     """
     check if the given BBox is valid
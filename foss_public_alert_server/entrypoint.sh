@@ -10,9 +10,11 @@ export PROMETHEUS_MULTIPROC_DIR=/tmp/fpas-metrics
 
 uv run --no-sync --no-cache manage.py collectstatic --clear --no-input
 uv run --no-sync --no-cache manage.py migrate
+uv run --no-sync --no-cache manage.py build_geocode_store
 
 uv run --no-sync --no-cache celery -A foss_public_alert_server worker --loglevel=INFO -n general --concurrency 4 &
-uv run --no-sync --no-cache celery -A foss_public_alert_server worker --loglevel=INFO -Q push_notifications -n notifications --concurrency 1 &
+uv run --no-sync --no-cache celery -A foss_public_alert_server worker --loglevel=INFO -Q feeds -n feeds --pool threads --concurrency 32 &
+uv run --no-sync --no-cache celery -A foss_public_alert_server worker --loglevel=INFO -Q push_notifications -n notifications --concurrency 2 &
 uv run --no-sync --no-cache celery -A foss_public_alert_server beat -l INFO --scheduler django_celery_beat.schedulers:DatabaseScheduler &
 uv run --no-sync --no-cache celery -A foss_public_alert_server flower --url_prefix=flower &
 
@@ -30,9 +30,6 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
 
-# set timelimit for periodic background task to 30s soft and 60s hard
-app.control.time_limit('task.create_parser_and_get_feed', soft=30, hard=60, reply=True)
-
 # disable taks receiving and task success logging
 strategy.logger.setLevel(logging.WARNING)
 trace.logger.setLevel(logging.WARNING)
@@ -76,6 +73,10 @@ app.conf.beat_schedule = {
         'task': 'task.remove_expired_alerts',
         'schedule': crontab(minute="0", hour="*"),
     },
+    'remove_expired_http_cache_entries_every_hour': {
+        'task': 'task.remove_expired_http_cache_entries',
+        'schedule': crontab(minute="30", hour="*"),
+    },
     'create_test_alert_every_five_minutes': {
         'task': 'task.create_test_alert',
         'schedule': crontab(minute="*/5"),
@@ -157,6 +157,97 @@ SECURE_REFERRER_POLICY = "strict-origin-when-cross-origin"
 
 # timeperiod in seconds for feed updates used by the celery task scheduler
 DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS = 60
+# bounds in seconds of the adaptive update period of the feeds
+MIN_UPDATE_PERIOD_FOR_CAP_FEEDS = 60
+MAX_UPDATE_PERIOD_FOR_CAP_FEEDS = 15 * 60
+# factor the update period of a feed is widened by after a fetch without changes
+UPDATE_PERIOD_BACKOFF_FACTOR = 1.5
+# the update period of a feed is at least this multiple of the time the last fetch took
+UPDATE_PERIOD_FETCH_DURATION_FACTOR = 4
+
+# number of threads per feed fetch downloading the CAP messages linked from a feed
+CAP_DOWNLOAD_THREADS = 8
+# max number of concurrent CAP message downloads from the same server per feed fetch
+CAP_DOWNLOADS_PER_ORIGIN = 4
+# number of servers and connections per server kept open for fetching feeds per worker process
+FEED_HTTP_POOL_HOSTS = 500
+FEED_HTTP_POOL_SIZE = 32
+
+# number of subscriptions notified by one push notification task
+PUSH_NOTIFICATION_BATCH_SIZE = 500
+# number of threads per push notification worker process sending notifications concurrently
+PUSH_DELIVERY_THREADS = 32
+# max number of concurrent connections to the same push server per push notification worker process
+PUSH_CONNECTIONS_PER_HOST = 8
+# max number of push notifications per second sent to the same push server per push notification worker process.
+# This only protects push servers from being flooded, servers asking us to slow down get a backoff anyway
+PUSH_HOST_RATE = float(os.getenv('PUSH_HOST_RATE', 500))
+# the rate limits of push servers needing a different one than PUSH_HOST_RATE, e.g. 'ntfy.example.org=10;...'
+PUSH_HOST_RATE_LIMITS = {host: float(rate) for host, rate in
+                         (entry.split('=', 1) for entry in os.getenv('PUSH_HOST_RATE_LIMITS', '').split(';') if entry)}
+# number of push notifications that can be sent to the same push server at once before its rate limit applies
+PUSH_HOST_BURST = 1000
+# max time in seconds a push notification waits for the rate limit of its push server, it is deferred otherwise
+PUSH_HOST_MAX_WAIT = 5
+# max number of times the delivery of a notification is deferred due to the rate limit or backoff of its push server
+PUSH_MAX_DEFERRALS = 20
+# time in seconds we stop sending to a push server after a failure, doubled with every consecutive failure.
+# Retry-After headers of push servers are honored up to the max.
+PUSH_HOST_BACKOFF_MIN = 10
+PUSH_HOST_BACKOFF_MAX = 30 * 60
+# time in seconds after which a push notification worker picks up the backoffs set by the other workers
+PUSH_HOST_STATE_SYNC_INTERVAL = 10
+# min time in seconds between the notifications for updates of the same alert. The first update is sent immediately,
+# further updates within this time are delayed until it has passed and sent together
+ALERT_UPDATE_COALESCING_WINDOW = 120
+
+# cell size in degrees of the grid of the in-memory subscription index used to find the subscriptions of an alert
+SUBSCRIPTION_INDEX_GRID = 1.0
+# subscriptions covering more grid cells than this are checked for every alert instead
+SUBSCRIPTION_INDEX_MAX_CELLS = 400
+# min time in seconds between two updates of the subscription index with new and modified subscriptions
+SUBSCRIPTION_INDEX_UPDATE_INTERVAL = 10
+# interval in seconds the subscription index is rebuilt from scratch, this also removes deleted subscriptions.
+# Every push notification worker process rebuilds its index in a background thread
+SUBSCRIPTION_INDEX_REBUILD_INTERVAL = 60 * 60
+# time in seconds the updates of the subscription index overlap to not miss subscriptions committed late
+SUBSCRIPTION_INDEX_SYNC_MARGIN = 60
+
+# responses of the alert area endpoint are cached for bounding boxes extended to a grid of this size in degrees
+ALERT_AREA_CACHE_GRID = 1.0
+# max time in seconds an alert area response is cached, it is invalidated anyway as soon as the alerts change
+ALERT_AREA_CACHE_TIMEOUT = 60 * 60
+
+# SQLite database of the HTTP cache shared by all feeds
+FEED_HTTP_CACHE_PATH = os.getenv('FEED_HTTP_CACHE_PATH', BASE_DIR.joinpath('cache', 'feeds.sqlite'))
+
+# SQLite database with the indexed geocode geometries, created from alertHandler/data by "manage.py build_geocode_store"
+GEOCODE_STORE_PATH = os.getenv('GEOCODE_STORE_PATH', BASE_DIR.joinpath('cache', 'geocodes.sqlite'))
+# number of decoded geocode geometries kept in memory per worker process
+GEOCODE_STORE_CACHE_SIZE = int(os.getenv('GEOCODE_STORE_CACHE_SIZE', 256))
+# number of united areas of sets of geocodes kept in memory per worker process
+GEOCODE_AREA_CACHE_SIZE = int(os.getenv('GEOCODE_AREA_CACHE_SIZE', 128))
+
+# shared by the web server and all celery workers, the tables are created by migrations of alertHandler
+CACHES = {
+    # state of the workers, e.g. feed locks, push server backoffs and the alert generation. It must not be culled,
+    # the number of entries grows only with the number of feeds, push servers and alerts and stays far below the limit
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        },
+    },
+    # the alerts of the grid cells of the area endpoint, culled when full
+    'alert_areas': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'alert_area_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -167,6 +258,14 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+# feed fetches are mostly waiting for the network, they run on a separate worker with many threads.
+# Celery doesn't enforce task time limits on the threads pool, feed fetches are only bounded by the HTTP timeouts
+CELERY_TASK_ROUTES = {
+    'task.create_parser_and_get_feed': {'queue': 'feeds'},
+}
+# time in seconds after which the lock of a feed fetch expires, so a feed is never fetched twice at the same time
+# even if its periodic task is due again before the last fetch finished. Must be longer than the slowest fetch
+FEED_LOCK_TIMEOUT = 10 * 60
 
 # for Celery metrics exporter
 CELERY_WORKER_SEND_TASK_EVENTS = True
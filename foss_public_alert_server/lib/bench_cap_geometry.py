@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: Volker Krause <vkrause@kde.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""
+Micro-benchmark for computing alert areas from the CAP messages in testdata/.
+
+Compares the polygon union used by cap_geometry with uniting the polygons one by one.
+Run from this directory: PYTHONPATH=.. python3 bench_cap_geometry.py [number of repetitions]
+"""
+
+import os
+import sys
+import timeit
+
+import cap
+import cap_geometry
+
+from django.contrib.gis.geos import MultiPolygon
+
+
+def iterative_union(polys):
+    mp = MultiPolygon()
+    for poly in polys:
+        mp = mp.union(poly)
+    return mp if mp.geom_typeid == 6 else MultiPolygon(mp)
+
+
+def alert_polygons(cap_msg):
+    polys = []
+    for cap_poly in cap_msg.polygons():
+        polys += cap_geometry.normalize_polygon(cap_geometry.polygon_from_cap_polygon(cap_poly))
+    for cap_circle in cap_msg.circles():
+        polys += cap_geometry.polygon_from_cap_circle(cap_circle)
+    return [p for p in polys if p is not None and p.geom_typeid in [3, 6]]
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print(f"{'file':<72} {'polygons':>8} {'iterative':>10} {'union':>10} {'speedup':>8}")
+    for file_name in sorted(os.listdir('testdata')):
+        if not file_name.endswith('.xml'):
+            continue
+        try:
+            cap_msg = cap.CAPAlertMessage.from_file(os.path.join('testdata', file_name))
+        except Exception:
+            continue  # not a CAP message
+        polys = alert_polygons(cap_msg)
+        if not polys:
+            continue
+
+        iterative = timeit.timeit(lambda: iterative_union(polys), number=repetitions) / repetitions
+        union = timeit.timeit(lambda: cap_geometry.union_polygons(polys), number=repetitions) / repetitions
+        print(f"{file_name:<72} {len(polys):>8} {iterative * 1000:>8.2f}ms {union * 1000:>8.2f}ms "
+              f"{iterative / union:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -198,6 +198,40 @@ class CAPAlertMessage:
             circles |= set(cap_info.circles())
         return list(circles)
 
+    @staticmethod
+    def peek_identifier_and_sent_time(cap_data: str) -> (str, datetime):
+        """
+        Returns the identifier and sent time of the given CAP XML string without parsing the entire message.
+        Parsing stops as soon as both are found, which is usually within the first few hundred bytes.
+        Either value is None if not present or if the message can't be parsed, this does not validate the message.
+        """
+        identifier = None
+        sent_time = None
+        pull_parser = ET.XMLPullParser(events=('start', 'end'))
+        depth = 0
+        try:
+            for offset in range(0, len(cap_data), 1024):
+                pull_parser.feed(cap_data[offset:offset + 1024])
+                for event, elem in pull_parser.read_events():
+                    if event == 'start':
+                        depth += 1
+                        # the header elements precede the info elements
+                        if depth == 2 and elem.tag.endswith('}info'):
+                            return identifier, sent_time
+                        continue
+                    depth -= 1
+                    if depth != 1 or not elem.text:
+                        continue
+                    if elem.tag.endswith('}identifier'):
+                        identifier = elem.text
+                    elif elem.tag.endswith('}sent'):
+                        sent_time = parser.isoparse(elem.text)
+                    if identifier is not None and sent_time is not None:
+                        return identifier, sent_time
+        except (ET.ParseError, ValueError):
+            pass
+        return identifier, sent_time
+
     @staticmethod
     def from_string(cap_data: str):
         """
@@ -208,6 +242,62 @@ class CAPAlertMessage:
         msg.xml = ET.fromstring(cap_data)
         return msg
 
+    @staticmethod
+    def from_element(element: ET.Element):
+        """
+        Returns a CAPAlertMessage object for an already parsed CAP alert XML element,
+        e.g. one embedded in a feed document. The element is used directly, not copied.
+        """
+        ET.register_namespace('', 'urn:oasis:names:tc:emergency:cap:1.2')
+        msg = CAPAlertMessage()
+        msg.xml = element
+        return msg
+
+    @staticmethod
+    def normalize_namespace(element: ET.Element) -> bool:
+        """
+        Converts the given CAP v1.1 alert XML element in place to CAP v1.2 by renaming the namespace of all elements.
+        Returns whether anything had to be changed.
+        """
+        modified = False
+        for node in element.iter():
+            if isinstance(node.tag, str) and node.tag.startswith('{urn:oasis:names:tc:emergency:cap:1.1}'):
+                node.tag = '{urn:oasis:names:tc:emergency:cap:1.2}' + node.tag[38:]
+                modified = True
+        return modified
+
+    @staticmethod
+    def iter_alert_elements(source):
+        """
+        Incrementally parses the given XML document and yields every CAP alert element in it as soon as it is
+        complete, e.g. for EDXL or Atom feeds embedding many CAP messages.
+        Once the iteration continues the yielded element is removed from the document and cleared, as is all other
+        content outside of CAP alert elements, so the memory use doesn't grow with the size of the feed.
+        Callers therefore must not keep references to yielded elements.
+        :param source: a file name or file object containing the XML document
+        """
+        alert_tags = ('{urn:oasis:names:tc:emergency:cap:1.2}alert', '{urn:oasis:names:tc:emergency:cap:1.1}alert')
+        ancestors = []
+        # the depth of the alert element currently being read, if any
+        alert_depth = None
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if alert_depth is None and elem.tag in alert_tags:
+                    alert_depth = len(ancestors)
+                ancestors.append(elem)
+                continue
+
+            ancestors.pop()
+            if alert_depth is not None:
+                if len(ancestors) > alert_depth:
+                    # content of the alert element, needed until the entire alert is read
+                    continue
+                alert_depth = None
+                yield elem
+            if ancestors:
+                ancestors[-1].remove(elem)
+            elem.clear()
+
     @staticmethod
     def from_file(file_name):
         """
@@ -4,15 +4,20 @@
 from lib import cap
 from lib import geomath
 
-from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.contrib.gis.geos import GeometryCollection, MultiPolygon, Polygon
 
 
 def polygon_from_cap_polygon(cap_polygon):
     """
     Create a GEOS Polygon from a CAP polygon description.
     """
-    coords = cap.CAPPolygon.parse_polygon(cap_polygon)
+    return polygon_from_coordinates(cap.CAPPolygon.parse_polygon(cap_polygon))
 
+
+def polygon_from_coordinates(coords):
+    """
+    Create a GEOS Polygon from a closed list of (lon, lat) tuples, fixing self-intersections if necessary.
+    """
     poly = Polygon(coords)
     if not poly.valid:
         poly = poly.make_valid()  # try to fix self-intersections
@@ -90,26 +95,139 @@ def polygon_from_cap_circle(cap_circle: str):
                 Polygon.from_bbox((-180, lat - dlat, lon + dlon - 360, lat + dlat))]
 
 
+def polygons_from_geojson_feature(geojson) -> list:
+    """
+    Create a list of GEOS Polygons from a GeoJSON feature.
+    This produces the same geometry as adding the feature to a CAP alert with cap_geojson.geojson_feature_to_cap
+    and parsing the resulting CAP polygons, without the detour through the CAP polygon strings.
+    """
+    geometry = geojson['geometry']
+    if geometry['type'] == 'Polygon':
+        geojson_polys = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        geojson_polys = geometry['coordinates']
+    else:
+        return []
+
+    polys = []
+    for geojson_poly in geojson_polys:
+        # like CAP polygons, only consider the outer ring with the CAP coordinate precision
+        if len(geojson_poly[0]) < 4:
+            continue
+        coords = [(round(coord[0], 4), round(coord[1], 4)) for coord in geojson_poly[0]]
+        if coords[0] != coords[-1]:
+            coords.append(coords[0])
+        poly = polygon_from_coordinates(coords)
+        if poly is not None:
+            polys += normalize_polygon(poly)
+    return polys
+
+
 def multipolygon_from_cap_alert(cap_alert: cap.CAPAlertMessage):
     """
     Returns a GEOS MultiPolygon for the affected area of the given CAP alert message.
     """
+    return multipolygon_from_cap_areas(cap_alert.polygons(), cap_alert.circles())
+
+
+def multipolygon_from_cap_areas(cap_polygons: list, cap_circles: list, geometries: list = ()):
+    """
+    Returns a GEOS MultiPolygon for the given CAP polygon and circle strings and additional GEOS (Multi)Polygons.
+    """
     polys = []
-    for cap_poly in cap_alert.polygons():
+    for cap_poly in cap_polygons:
         polys += normalize_polygon(polygon_from_cap_polygon(cap_poly))
-    for cap_circle in cap_alert.circles():
+    for cap_circle in cap_circles:
         polys += polygon_from_cap_circle(cap_circle)
+    polys += geometries
     polys = [p for p in polys if p is not None]
 
-    # don't use MultiPolygon(polys), that assumes intersection-free
-    # polygons. Instead do the more expensive-unioning that handles
-    # overlapping polygons correctly.
-    mp = MultiPolygon()
+    valid_polys = []
     for poly in polys:
         if poly.geom_typeid in [1, 4, 5, 7]:
             print(f"skipping invalid geometry type: {poly.json}")
             continue
-        mp = mp.union(poly)
+        if not poly.empty:
+            valid_polys.append(poly)
+    return union_polygons(valid_polys)
+
+
+def _extent_contains(outer, inner) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def _extents_overlap(a, b) -> bool:
+    # touching counts as overlapping, such polygons still need to be merged
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _remove_covered_polygons(polys: list) -> list:
+    """
+    Drop polygons that are entirely covered by another polygon of the list.
+    Only polygons with a containing bounding box are checked for actual containment.
+    :param polys: list of (extent, polygon) tuples
+    """
+    # larger polygons first, a polygon can only be covered by one with a larger bounding box
+    polys = sorted(polys, key=lambda p: (p[0][2] - p[0][0]) * (p[0][3] - p[0][1]), reverse=True)
+    result = []
+    for extent, poly in polys:
+        if not any(_extent_contains(other_extent, extent) and other.prepared.covers(poly)
+                   for other_extent, other in result):
+            result.append((extent, poly))
+    return result
+
+
+def _has_overlapping_extents(extents: list) -> bool:
+    """
+    Check whether any two bounding boxes overlap, sweeping along the longitude axis.
+    """
+    active = []
+    for extent in sorted(extents, key=lambda e: e[0]):
+        active = [other for other in active if other[2] >= extent[0]]
+        if any(_extents_overlap(other, extent) for other in active):
+            return True
+        active.append(extent)
+    return False
+
+
+# below this number of polygons union_polygons() unites them one by one
+SMALL_UNION_POLYGON_COUNT = 8
+
+
+def union_polygons(polys: list):
+    """
+    Returns a GEOS MultiPolygon covering the union of the given GEOS (Multi)Polygons.
+    """
+    if not polys:
+        return MultiPolygon()
+    if len(polys) == 1 and polys[0].valid:
+        return polys[0].clone() if polys[0].geom_typeid == 6 else MultiPolygon(polys[0])
+
+    # for a few polygons the pre-processing below costs more than it saves
+    if len(polys) < SMALL_UNION_POLYGON_COUNT:
+        mp = MultiPolygon()
+        for poly in polys:
+            mp = mp.union(poly)
+        return mp if mp.geom_typeid == 6 else MultiPolygon(mp)
+
+    # split MultiPolygons, so their parts can be filtered and checked individually
+    parts = []
+    for poly in polys:
+        if poly.geom_typeid == 6:
+            parts += [p for p in poly if not p.empty]
+        else:
+            parts.append(poly)
+
+    # computing the extent isn't free for large polygons, so only do that once
+    parts = _remove_covered_polygons([(p.extent, p) for p in parts])
+
+    # polygons with disjoint bounding boxes cannot intersect, so they form a valid
+    # MultiPolygon as-is. Otherwise don't use MultiPolygon(polys), that assumes
+    # intersection-free polygons, but unite all of them at once, which is much
+    # cheaper than uniting them one by one.
+    if not _has_overlapping_extents([extent for extent, _ in parts]):
+        return MultiPolygon([p for _, p in parts])
+    mp = GeometryCollection([p for _, p in parts]).unary_union
 
     # normalize to a MultiPolygon, if the above simplified the geometry,
     # we need that for storing this in the same DB column type
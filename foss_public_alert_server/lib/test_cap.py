@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import datetime
+import io
 import unittest
 
 import cap
@@ -19,6 +20,34 @@ class TestCAP(unittest.TestCase):
         sent_time = cap_msg.sent_time()
         self.assertEqual(sent_time, datetime.datetime.fromisoformat("2024-04-21T11:51:29-03:00"))
 
+    def test_peek_identifier_and_sent_time(self):
+        with open("../alertHandler/test_data/test_cap_data_1.xml") as f:
+            cap_data = f.read()
+        cap_id, sent_time = cap.CAPAlertMessage.peek_identifier_and_sent_time(cap_data)
+        self.assertEqual(cap_id, "urn:oid:1234.5678")
+        self.assertEqual(sent_time, datetime.datetime.fromisoformat("2024-04-21T11:51:29-03:00"))
+
+        self.assertEqual(cap.CAPAlertMessage.peek_identifier_and_sent_time("<alert"), (None, None))
+        self.assertEqual(cap.CAPAlertMessage.peek_identifier_and_sent_time(
+            '<alert xmlns="urn:oasis:names:tc:emergency:cap:1.1"><identifier>abc</identifier><info/></alert>'),
+            ("abc", None))
+
+    def test_iter_alert_elements(self):
+        feed = io.BytesIO(b'<feed xmlns="http://www.w3.org/2005/Atom">'
+                          b'<entry><title>1</title><content>'
+                          b'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.2"><identifier>a</identifier></alert>'
+                          b'</content></entry>'
+                          b'<entry><title>2</title><content>'
+                          b'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.1"><identifier>b</identifier></alert>'
+                          b'</content></entry></feed>')
+        ids = []
+        modified = []
+        for elem in cap.CAPAlertMessage.iter_alert_elements(feed):
+            modified.append(cap.CAPAlertMessage.normalize_namespace(elem))
+            ids.append(cap.CAPAlertMessage.from_element(elem).identifier())
+        self.assertEqual(ids, ["a", "b"])
+        self.assertEqual(modified, [False, True])
+
     def test_expire_time(self):
         cap_msg = cap.CAPAlertMessage.from_file("../alertHandler/test_data/test_cap_data_1.xml")
         expire_time = cap_msg.expire_time()
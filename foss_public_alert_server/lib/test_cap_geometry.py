@@ -1,11 +1,16 @@
 # SPDX-FileCopyrightText: Volker Krause <vkrause@kde.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
 import unittest
+import xml.etree.ElementTree as ET
 
 import cap
+import cap_geojson
 import cap_geometry
 
+from django.contrib.gis.geos import Polygon
+
 
 class TestCAP(unittest.TestCase):
 
@@ -162,6 +167,38 @@ class TestCAP(unittest.TestCase):
         self.assertAlmostEqual(poly.extent[0], -180)
         self.assertAlmostEqual(poly.extent[2], 180)
 
+    def test_polygons_from_geojson_feature(self):
+        with open("../alertHandler/data/EMMA_ID/AT001.geojson") as f:
+            geojson = json.load(f)
+        area = ET.Element('{urn:oasis:names:tc:emergency:cap:1.2}area')
+        self.assertTrue(cap_geojson.geojson_feature_to_cap(area, geojson))
+        cap_polygons = [poly.text for poly in area.findall('{urn:oasis:names:tc:emergency:cap:1.2}polygon')]
+
+        expected = cap_geometry.multipolygon_from_cap_areas(cap_polygons, [])
+        poly = cap_geometry.multipolygon_from_cap_areas([], [], cap_geometry.polygons_from_geojson_feature(geojson))
+        self.assertTrue(poly.valid)
+        self.assertEqual(poly.extent, expected.extent)
+        self.assertAlmostEqual(poly.sym_difference(expected).area, 0.0)
+
+    def test_union_polygons(self):
+        outer = Polygon.from_bbox((0, 0, 10, 10))
+        covered = Polygon.from_bbox((2, 2, 4, 4))
+        overlapping = Polygon.from_bbox((8, 8, 12, 12))
+        disjoint = Polygon.from_bbox((20, 20, 22, 22))
+
+        poly = cap_geometry.union_polygons([covered, disjoint])
+        self.assertEqual(poly.geom_typeid, 6)
+        self.assertEqual(poly.num_geom, 2)
+        self.assertAlmostEqual(poly.area, 8.0)
+
+        poly = cap_geometry.union_polygons([covered, outer, overlapping, disjoint])
+        self.assertTrue(poly.valid)
+        self.assertEqual(poly.geom_typeid, 6)
+        self.assertEqual(poly.num_geom, 2)
+        self.assertAlmostEqual(poly.area, 100.0 + 16.0 - 4.0 + 4.0)
+
+        self.assertEqual(cap_geometry.union_polygons([]).num_geom, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sourceFeedHandler', '0005_alter_capfeedsource_source_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capfeedsource',
+            name='update_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
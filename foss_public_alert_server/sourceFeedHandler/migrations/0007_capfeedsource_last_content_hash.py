@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sourceFeedHandler', '0006_capfeedsource_update_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capfeedsource',
+            name='last_content_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -2,7 +2,10 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from django.db import models
+import math
 import uuid
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 from django.dispatch import receiver
 from django_celery_beat.models import PeriodicTask, IntervalSchedule
@@ -38,6 +41,8 @@ class CAPFeedSource(models.Model):
     last_e_tag = models.CharField(max_length=255, null=True, blank=True)
     periodic_task_name = models.CharField(max_length=255, null=True)
     latest_published_alert_datetime = models.DateTimeField(null=True, blank=True)
+    update_interval = models.PositiveIntegerField(null=True, blank=True)
+    last_content_hash = models.CharField(max_length=64, null=True, blank=True)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -50,7 +55,7 @@ class CAPFeedSource(models.Model):
         create a periodic task for this feed source
         :return: None
         """
-        schedule = self.get_or_create_interval()
+        schedule = self.get_or_create_interval(self.update_interval)
         task_name = f'periodic feed updater for - {self.source_id} - {self.id}'
         # only create task if it not already exists and if the feed is not set to ignore
         if not PeriodicTask.objects.filter(name=task_name).exists():
@@ -64,18 +69,89 @@ class CAPFeedSource(models.Model):
             self.periodic_task_name = task_name
 
     @staticmethod
-    def get_or_create_interval():
+    def get_or_create_interval(every: int = None):
         """
         get or create an interval for the periodic scheduler
-        uses settings.DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS as period
+        :param every: the period in seconds, settings.DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS if not specified
         :return:
         """
         schedule, created = IntervalSchedule.objects.get_or_create(
-            every=settings.DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS,
+            every=every or settings.DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS,
             period=IntervalSchedule.SECONDS,
         )
         return schedule
 
+    def adapt_update_interval(self, changed: bool | None, fetch_duration: timedelta, headers=None) -> None:
+        """
+        adapt the update interval of this feed to how often it changes.
+        The interval is reset to the minimum as soon as alerts change and widened step by step while nothing changes,
+        but never shorter than the feed server asks for via its HTTP caching headers or than a multiple of the time
+        a fetch takes.
+        :param changed: true if alerts were added, updated or removed, false if nothing changed, None if the fetch failed
+        :param fetch_duration: the duration of the fetch
+        :param headers: the HTTP response headers of the feed, if available
+        :return: None
+        """
+        min_interval = settings.MIN_UPDATE_PERIOD_FOR_CAP_FEEDS
+        max_interval = settings.MAX_UPDATE_PERIOD_FOR_CAP_FEEDS
+        interval = self.update_interval or settings.DEFAULT_UPDATE_PERIOD_FOR_CAP_FEEDS
+        if changed:
+            interval = min_interval
+        elif changed is False:
+            interval *= settings.UPDATE_PERIOD_BACKOFF_FACTOR
+
+        interval = max(interval,
+                       self.interval_from_http_headers(headers),
+                       fetch_duration.total_seconds() * settings.UPDATE_PERIOD_FETCH_DURATION_FACTOR)
+        # round to full minimum intervals, to not create a new schedule for every feed
+        interval = min(max_interval, max(min_interval, math.ceil(interval / min_interval) * min_interval))
+        if interval == self.update_interval:
+            return
+
+        self.update_interval = interval
+        CAPFeedSource.objects.filter(id=self.id).update(update_interval=interval)
+        schedule = self.get_or_create_interval(interval)
+        # save() instead of update() so the beat scheduler gets notified about the change
+        for task in PeriodicTask.objects.filter(name=self.periodic_task_name).exclude(interval=schedule):
+            task.interval = schedule
+            task.save()
+
+    @staticmethod
+    def interval_from_http_headers(headers) -> float:
+        """
+        get the time until the next fetch the feed server asks for via Retry-After, Cache-Control or Expires headers
+        :param headers: the HTTP response headers, can be None
+        :return: the time in seconds, 0 if the server doesn't specify any
+        """
+        if not headers:
+            return 0
+        now = datetime.now(timezone.utc)
+
+        def seconds_until(value: str) -> float:
+            try:
+                return (parsedate_to_datetime(value) - now).total_seconds()
+            except (TypeError, ValueError):
+                return 0
+
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            return float(retry_after) if retry_after.strip().isdigit() else seconds_until(retry_after)
+
+        cache_control = [directive.strip().lower() for directive in headers.get('Cache-Control', '').split(',')]
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        for directive in cache_control:
+            if directive.startswith('max-age='):
+                try:
+                    return max(0, int(directive[8:]) - int(headers.get('Age', 0)))
+                except ValueError:
+                    return 0
+
+        expires = headers.get('Expires')
+        if expires:
+            return seconds_until(expires)
+        return 0
+
 
 @receiver(models.signals.post_delete, sender=CAPFeedSource)
 def auto_delete_periodic_task_on_delete(sender, instance:CAPFeedSource, **kwargs) -> None:
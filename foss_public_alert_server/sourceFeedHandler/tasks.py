@@ -5,6 +5,8 @@ import json
 import logging
 
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django_celery_beat.models import PeriodicTask
 
@@ -154,7 +156,15 @@ def create_parser_and_get_feed(feed_id: str, feed_format:str) -> None :
         case "embedded CAP":
             parser = EmbeddedCAPParser(feed)
     if parser is not None:
-        parser.get_feed(parser)
+        # the threads pool doesn't enforce time limits, skip this run if the last fetch of the feed is still running
+        lock = f"feed-lock:{feed_id}"
+        if not cache.add(lock, True, timeout=settings.FEED_LOCK_TIMEOUT):
+            logger.warning(f"{feed.source_id}: last fetch still running - skipping")
+            return
+        try:
+            parser.get_feed(parser)
+        finally:
+            cache.delete(lock)
     else:
         logger.error(f"{feed.source_id}: Parser is None for {feed_format}")
 
@@ -2,9 +2,15 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import logging
+from datetime import timedelta
+from unittest.mock import patch
 
+from django.core.cache import cache
 from django.test import TestCase, RequestFactory, Client
 from django.http.request import HttpRequest
+from django_celery_beat.models import IntervalSchedule, PeriodicTask
+from .models import CAPFeedSource
+from .tasks import create_parser_and_get_feed
 from .views import get_feed_status_for_area
 
 logging.basicConfig(level=logging.INFO)
@@ -57,4 +63,49 @@ class SourceFeedHandlerTestsCase(TestCase):
 
         response = self.client.post("/sources/area_status", data)
 
-        self.assertContains(response,b'', status_code=405)
\ No newline at end of file
+        self.assertContains(response,b'', status_code=405)
+
+    def test_interval_from_http_headers(self):
+        self.assertEqual(CAPFeedSource.interval_from_http_headers(None), 0)
+        self.assertEqual(CAPFeedSource.interval_from_http_headers({'Cache-Control': 'public, max-age=300'}), 300)
+        self.assertEqual(CAPFeedSource.interval_from_http_headers({'Cache-Control': 'max-age=300', 'Age': '100'}), 200)
+        self.assertEqual(CAPFeedSource.interval_from_http_headers({'Cache-Control': 'no-cache, max-age=300'}), 0)
+        self.assertEqual(CAPFeedSource.interval_from_http_headers({'Retry-After': '120',
+                                                                   'Cache-Control': 'max-age=300'}), 120)
+        self.assertLess(CAPFeedSource.interval_from_http_headers({'Expires': 'Thu, 01 Dec 1994 16:00:00 GMT'}), 0)
+
+    def test_adapt_update_interval(self):
+        feed = CAPFeedSource.objects.filter(cap_alert_feed_status="operating", ignore=False).first()
+        feed.adapt_update_interval(False, timedelta(seconds=1))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 120)
+        # the periodic task of the feed is moved to the new interval
+        task = PeriodicTask.objects.get(name=feed.periodic_task_name)
+        self.assertEqual((task.interval.every, task.interval.period), (120, IntervalSchedule.SECONDS))
+        feed.adapt_update_interval(False, timedelta(seconds=1))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 180)
+        feed.adapt_update_interval(None, timedelta(seconds=1))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 180)
+        for i in range(0, 10):
+            feed.adapt_update_interval(False, timedelta(seconds=1))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 900)
+        feed.adapt_update_interval(True, timedelta(seconds=1))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 60)
+        feed.adapt_update_interval(True, timedelta(seconds=1), {'Cache-Control': 'max-age=200'})
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 240)
+        feed.adapt_update_interval(True, timedelta(seconds=40))
+        self.assertEqual(CAPFeedSource.objects.get(id=feed.id).update_interval, 180)
+        self.assertEqual(PeriodicTask.objects.get(name=feed.periodic_task_name).interval.every, 180)
+
+    def test_create_parser_and_get_feed_lock(self):
+        feed = CAPFeedSource.objects.filter(format="rss or atom").first()
+        with patch('sourceFeedHandler.tasks.XMLCAPParser.get_feed') as get_feed:
+            # the feed is skipped while another fetch holds its lock
+            cache.set(f"feed-lock:{feed.id}", True)
+            create_parser_and_get_feed(str(feed.id), feed.format)
+            get_feed.assert_not_called()
+
+            cache.delete(f"feed-lock:{feed.id}")
+            create_parser_and_get_feed(str(feed.id), feed.format)
+            get_feed.assert_called_once()
+            # the lock is released after the fetch
+            self.assertIsNone(cache.get(f"feed-lock:{feed.id}"))
@@ -3,18 +3,11 @@
 
 from django.contrib import admin
 from django.contrib.gis import admin
-from .models import Subscription, ConnectionFlag
+from .models import Subscription
 
 class SubscriptionAdmin(admin.GISModelAdmin):
     list_display = ['id', 'last_heartbeat']
     search_fields = ['id', 'token', 'user_agent']
 
-class ConnectionFlagAdmin(admin.GISModelAdmin):
-    list_display = ['hostname', 'set_time_stamp', 'time_out', 'error_message']
-    search_fields = ['hostname', 'error_message']
-
 # Register your models here.
 admin.site.register(Subscription, SubscriptionAdmin)
-
-admin.site.register(ConnectionFlag, ConnectionFlagAdmin)
-
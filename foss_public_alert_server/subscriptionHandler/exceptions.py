@@ -7,13 +7,20 @@ class PushNotificationCheckFailed(Exception):
 
 class PushNotificationException(Exception):
     error_code: str
+    # time in seconds after which the notification should be tried again, if the push server asked us to wait
+    retry_after: float | None
 
-    def __init__(self, error_code: str = "unknown"):
+    def __init__(self, error_code: str = "unknown", retry_after: float = None):
         self.error_code = str(error_code)
+        self.retry_after = retry_after
 
 
 class PushNotificationTimeoutException(Exception):
-    pass
+    """The push server must not be contacted right now due to rate limiting or a backoff after failures.
+    """
+    def __init__(self, reason, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
 
 class PushNotificationExpiredException(Exception):
     """The push notification returned a 404 or 410 response.
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.9 on 2026-10-18 11:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptionHandler', '0010_connectionflag_error_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 5.2.9 on 2026-10-18 11:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptionHandler', '0011_subscription_modified'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ConnectionFlag',
+        ),
+    ]
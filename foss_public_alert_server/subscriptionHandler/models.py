@@ -25,9 +25,5 @@ class Subscription(models.Model):
     error_counter = models.IntegerField(default=0)
     error_messages = models.CharField(max_length=255, null=True)
     user_agent = models.CharField(max_length=255, null=True)
-
-class ConnectionFlag(models.Model):
-    hostname = models.CharField(primary_key=True, max_length=255)
-    set_time_stamp  = models.DateTimeField(default=datetime.now)
-    time_out = models.BooleanField()
-    error_message = models.CharField(max_length=255, null=True)
\ No newline at end of file
+    # used to update the in-memory subscription index of the push notification workers
+    modified = models.DateTimeField(auto_now=True, db_index=True)
@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from subscriptionHandler.models import Subscription
+from . import unified_push, unified_push_encrpted, apn, firebase
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_executor: ThreadPoolExecutor = None
+_host_limits: dict[str, threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+
+
+def send_notification(subscription: Subscription, payload: str) -> None:
+    """
+    send the payload to the given subscription using its push service
+    :param subscription: the subscription to notify
+    :param payload: the serialized push message
+    :return: None
+    :raise PushNotificationException: in case the push notification couldn't deliver
+    """
+    match subscription.push_service:
+        case subscription.PushServices.UNIFIED_PUSH:
+            unified_push.send_notification(subscription.token, payload)
+        case subscription.PushServices.UNIFIED_PUSH_ENCRYPTED:
+            unified_push_encrpted.send_notification(subscription.token,
+                                                    payload,
+                                                    auth_key=subscription.auth_key,
+                                                    p256dh_key=subscription.p256dh_key)
+        case subscription.PushServices.APN:
+            apn.send_notification(subscription.token, "", "", "", "", "")
+        case subscription.PushServices.FIREBASE:
+            firebase.send_notification(subscription.token, payload)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """
+    Internal. Get the thread pool of this process, created lazily to not share threads between forked workers.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.PUSH_DELIVERY_THREADS,
+                                           thread_name_prefix="push-delivery")
+        return _executor
+
+
+def _get_host_limit(endpoint: str) -> threading.BoundedSemaphore:
+    """
+    Internal. Get the semaphore limiting the concurrent requests to the push server of the given endpoint.
+    """
+    try:
+        host = urlsplit(endpoint).hostname
+    except ValueError:
+        host = None
+    with _lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(settings.PUSH_CONNECTIONS_PER_HOST)
+        return _host_limits[host]
+
+
+def _send_with_host_limit(subscription: Subscription, payload: str) -> Exception | None:
+    """
+    Internal. Send one notification while holding a connection slot of its push server.
+    Runs on a pool thread, which has its own database connection, e.g. for the rate limiter state in the cache.
+    :return: None if the notification was delivered, the raised exception otherwise
+    """
+    # drop connections which are unusable, e.g. after a database restart, or exceeded CONN_MAX_AGE
+    close_old_connections()
+    try:
+        with _get_host_limit(subscription.token):
+            try:
+                send_notification(subscription, payload)
+            except Exception as e:
+                return e
+        return None
+    finally:
+        close_old_connections()
+
+
+def send_notifications(subscriptions: list[Subscription], payload: str) -> list[tuple[Subscription, Exception | None]]:
+    """
+    send the same payload to all given subscriptions concurrently.
+
+    The requests run on a thread pool shared by the whole process, at most PUSH_CONNECTIONS_PER_HOST at the same time
+    to the same push server. Exceptions are not raised but returned per subscription, so the caller can apply the
+    retry and error counter handling for each subscription.
+    :param subscriptions: the subscriptions to notify
+    :param payload: the serialized push message
+    :return: a list of (subscription, exception) tuples in the order of subscriptions, the exception is None if the
+    notification was delivered
+    """
+    executor = _get_executor()
+    results = executor.map(lambda subscription: _send_with_host_limit(subscription, payload), subscriptions)
+    return list(zip(subscriptions, results))
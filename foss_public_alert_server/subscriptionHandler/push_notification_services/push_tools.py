@@ -2,58 +2,203 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import logging
-import tldextract
+import math
+import threading
+import time
+import requests
 from datetime import datetime, timezone
-from subscriptionHandler.models import ConnectionFlag
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
 from ..exceptions import PushNotificationTimeoutException
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def setTimeoutFlag(distributor_url:str, error_msg:str) -> None:
-    """
-    create a new timeout flag in the database. The flag is created from the domain name of the distributor_url
-    :param distributor_url: the server url
-    :param error_msg: the error message why the flag is set
-    :return: None
-    """
-    extracted_domain = tldextract.extract(distributor_url.lower())
-    if extracted_domain.subdomain:
-        push_server_url = f"{extracted_domain.subdomain}.{extracted_domain.domain}.{extracted_domain.suffix}"
-    else:
-        push_server_url = f"{extracted_domain.domain}.{extracted_domain.suffix}"
-    # check if there is already an entry for this url, and if yes update this entry, if not, create a new one
-    if ConnectionFlag.objects.filter(hostname=push_server_url).update(set_time_stamp=datetime.now(timezone.utc)) == 0:
-        flag = ConnectionFlag(
-            hostname=push_server_url,
-            time_out=True,
-            error_message=error_msg[:255]
-        )
-        flag.save()
-
-def checkTimeoutFlag(distributor_url:str):
-    """
-    check for the given distributor url if the server has an active timeout flag
-    :param distributor_url: the UnifiedPush endpoint
-    :return: None
-    :raise PushNotificationTimeoutException if the server has an active timeout flag
-    """
-    extracted_domain = tldextract.extract(distributor_url.lower())
-    if extracted_domain.subdomain:
-        push_server_url = f"{extracted_domain.subdomain}.{extracted_domain.domain}.{extracted_domain.suffix}"
-    else:
-        push_server_url = f"{extracted_domain.domain}.{extracted_domain.suffix}"
+_session: requests.Session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    get the process wide HTTP session used to deliver push notifications.
+    The session keeps a pool of keep-alive connections for every push server, so consecutive notifications to the
+    same server do not need a new TCP and TLS handshake each.
+    The session is created lazily to not share connections between forked worker processes.
+    :return: the shared session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=100, pool_maxsize=settings.PUSH_CONNECTIONS_PER_HOST)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def retry_after_from_headers(headers) -> float | None:
+    """
+    get the time a push server asks us to wait before sending further requests via the Retry-After header
+    :param headers: the HTTP response headers, can be None
+    :return: the time in seconds, None if the server doesn't specify it
+    """
+    retry_after = headers.get('Retry-After') if headers else None
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
     try:
-        flag = ConnectionFlag.objects.get(hostname=push_server_url)
-    except ConnectionFlag.DoesNotExist:
-        return
-    timedelta = datetime.now(timezone.utc) - flag.set_time_stamp
-    # check if the flag has expired
-    if timedelta.seconds > 300: # Expire the flag after 5 minutes
-        logger.debug(f"Timeout flag {flag.hostname} has expired. Deleting...")
-        flag.delete()
-        return
-    # if the flag is still valid, raise an exception
-    if flag.time_out:
-        logger.debug(f"Timeout flag for {push_server_url} has been set at {flag.set_time_stamp}")
-        raise PushNotificationTimeoutException(f"Timeout flag for {push_server_url} has been set at {flag.set_time_stamp}")
\ No newline at end of file
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class _HostState:
+    """
+    Internal. The rate limit state of one push server.
+    """
+
+    def __init__(self, rate: float):
+        # max number of requests per second
+        self.rate = rate
+        self.tokens = float(settings.PUSH_HOST_BURST)
+        self.updated = time.monotonic()
+        # wall clock time until which no requests must be sent, shared with the other worker processes
+        self.blocked_until = 0.0
+        # number of consecutive failures, for the exponential backoff
+        self.failures = 0
+        # monotonic time of the last synchronization with the shared state, None if never done
+        self.synced = None
+
+
+class HostRateLimiter:
+    """
+    Rate limiter for the requests to the push servers, with a token bucket per push server host and a backoff
+    after failures.
+
+    The token bucket is kept per process only and limits the number of notifications per second to each host, to
+    PUSH_HOST_RATE or the host's entry in PUSH_HOST_RATE_LIMITS.
+    The backoff is set on network errors or 429 responses, honoring a Retry-After header if present. It is shared
+    with the other worker processes via the Django cache, which is read at most every PUSH_HOST_STATE_SYNC_INTERVAL
+    seconds per host, so checking the rate limit usually doesn't need a database round trip.
+    """
+
+    def __init__(self):
+        self._hosts: dict[str, _HostState] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hostname(endpoint: str) -> str | None:
+        """
+        Internal. The host name of the push server of the given endpoint.
+        """
+        try:
+            return urlsplit(endpoint).hostname
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _cache_key(host: str) -> str:
+        """
+        Internal. The cache key of the shared backoff state of the given host.
+        """
+        return f"push-host-blocked:{host}"
+
+    def _get_state(self, host: str) -> _HostState:
+        """
+        Internal. Get the state of the given host, synchronized with the shared backoff state if due.
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState(settings.PUSH_HOST_RATE_LIMITS.get(host, settings.PUSH_HOST_RATE))
+            now = time.monotonic()
+            if state.synced is not None and now - state.synced < settings.PUSH_HOST_STATE_SYNC_INTERVAL:
+                return state
+            state.synced = now
+        blocked_until = cache.get(self._cache_key(host))
+        if blocked_until is not None:
+            with self._lock:
+                state.blocked_until = max(state.blocked_until, blocked_until)
+        return state
+
+    def acquire(self, endpoint: str) -> None:
+        """
+        wait until a request to the push server of the given endpoint can be sent
+        :param endpoint: the push endpoint
+        :return: None
+        :raise PushNotificationTimeoutException: if the push server is in backoff or the rate limit would make us
+        wait longer than PUSH_HOST_MAX_WAIT seconds, retry_after is set to the time until the request can be sent
+        """
+        host = self._hostname(endpoint)
+        state = self._get_state(host)
+        while True:
+            with self._lock:
+                now = time.time()
+                if state.blocked_until > now:
+                    raise PushNotificationTimeoutException(f"Backoff for {host} until {state.blocked_until}",
+                                                           retry_after=state.blocked_until - now)
+                monotonic_now = time.monotonic()
+                state.tokens = min(settings.PUSH_HOST_BURST,
+                                   state.tokens + (monotonic_now - state.updated) * state.rate)
+                state.updated = monotonic_now
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    return
+                wait = (1 - state.tokens) / state.rate
+            if wait > settings.PUSH_HOST_MAX_WAIT:
+                raise PushNotificationTimeoutException(f"Rate limit for {host} reached", retry_after=wait)
+            time.sleep(wait)
+
+    def report_success(self, endpoint: str) -> None:
+        """
+        reset the backoff of the push server of the given endpoint after a successful request
+        :param endpoint: the push endpoint
+        :return: None
+        """
+        host = self._hostname(endpoint)
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state.failures = 0
+
+    def report_failure(self, endpoint: str, error_msg: str, retry_after: float = None) -> float:
+        """
+        stop sending requests to the push server of the given endpoint for a while, the time doubles with every
+        consecutive failure. Requests failing while the server is in backoff already, e.g. the other concurrent
+        requests of the same outage, don't count as another failure.
+        :param endpoint: the push endpoint
+        :param error_msg: the error message why the backoff is set
+        :param retry_after: the time in seconds the push server asked us to wait, if any
+        :return: the time in seconds until requests may be sent to the push server again
+        """
+        host = self._hostname(endpoint)
+        state = self._get_state(host)
+        with self._lock:
+            if state.blocked_until <= time.time() or state.failures == 0:
+                state.failures += 1
+            if retry_after is None:
+                delay = settings.PUSH_HOST_BACKOFF_MIN * 2 ** min(state.failures - 1, 16)
+            else:
+                delay = retry_after
+            delay = min(delay, settings.PUSH_HOST_BACKOFF_MAX)
+            state.blocked_until = max(state.blocked_until, time.time() + delay)
+            blocked_until = state.blocked_until
+        logger.info(f"Backoff for {host} for {delay:.0f}s: {error_msg[:255]}")
+        cache.set(self._cache_key(host), blocked_until, timeout=math.ceil(blocked_until - time.time()))
+        return blocked_until - time.time()
+
+    def is_throttled(self, endpoint: str) -> bool:
+        """
+        check if the push server of the given endpoint is in backoff right now
+        """
+        state = self._get_state(self._hostname(endpoint))
+        with self._lock:
+            return state.blocked_until > time.time()
+
+
+# the rate limiter of this process
+rate_limiter = HostRateLimiter()
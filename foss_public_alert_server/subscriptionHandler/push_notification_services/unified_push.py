@@ -1,7 +1,6 @@
 # SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import requests
 from django.http import HttpResponseBadRequest
 from requests import Response, ConnectionError, HTTPError, ReadTimeout, RequestException, Timeout, ConnectTimeout
 import json
@@ -10,7 +9,7 @@ from datetime import datetime, timezone
 
 from subscriptionHandler.models import Subscription
 from subscriptionHandler.exceptions import PushNotificationException, PushNotificationTimeoutException
-from .push_tools import checkTimeoutFlag, setTimeoutFlag
+from .push_tools import get_session, rate_limiter, retry_after_from_headers
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,27 +24,30 @@ def send_notification(distributor_url, payload: json, persist_failures: bool = T
     Send a notification to a legacy unifiedPush endpoint without encryption
     :param distributor_url: the UnifiedPush endpoint
     :param payload: the push message to send
-    :param persist_failures: whether to record HTTP or network errors in the ConnectionFlag table
+    :param persist_failures: whether HTTP or network errors make us back off from the push server
     :raise PushNotificationException if the request failed
     """
     try:
-        checkTimeoutFlag(distributor_url)
-        res = requests.post(distributor_url, payload, timeout=10)
+        rate_limiter.acquire(distributor_url)
+        res = get_session().post(distributor_url, payload, timeout=10)
         if res.status_code == 429:
-            # rate limited
+            # rate limited, defer the notification until the push server accepts requests again
+            retry_after = retry_after_from_headers(res.headers)
             if persist_failures:
-                setTimeoutFlag(distributor_url, res.text)
+                retry_after = rate_limiter.report_failure(distributor_url, res.text, retry_after)
+            raise PushNotificationException(429, retry_after=retry_after)
         if res.status_code < 200 or res.status_code > 299:
             raise PushNotificationException(res.status_code)
+        rate_limiter.report_success(distributor_url)
         return res
 
     except PushNotificationTimeoutException as e:
         logger.error(f"Failed to send push notification due to {e}")
-        raise PushNotificationException("defer")
+        raise PushNotificationException("defer", retry_after=e.retry_after)
 
     except (ConnectTimeout, Timeout, ConnectionError, HTTPError, ReadTimeout, RequestException, OSError) as e:
         if persist_failures:
-            setTimeoutFlag(distributor_url, str(e))
+            rate_limiter.report_failure(distributor_url, str(e))
         logger.error(f"Failed to send push notification due to {e}")
         if isinstance(e, ConnectTimeout) or isinstance(e, Timeout) or isinstance(e, ReadTimeout):
             raise PushNotificationException("timeout")
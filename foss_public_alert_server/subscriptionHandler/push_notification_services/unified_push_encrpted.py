@@ -2,20 +2,74 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from django.http import HttpResponseBadRequest, HttpResponse, HttpResponseNotFound
-from pywebpush import webpush, WebPushException
+from pywebpush import WebPusher, WebPushException
+from py_vapid import Vapid
 from django.conf import settings
 import logging
+import threading
+import time
+from urllib.parse import urlsplit
 from datetime import datetime, timezone
 from requests import Response, HTTPError, Timeout, ConnectionError, ConnectTimeout, RequestException, ReadTimeout
 
 from subscriptionHandler.models import Subscription
-from .push_tools import checkTimeoutFlag, setTimeoutFlag
+from .push_tools import get_session, rate_limiter, retry_after_from_headers
 
 from ..exceptions import PushNotificationException, PushNotificationTimeoutException, PushNotificationExpiredException
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# VAPID tokens may be valid for at most 24h, we sign them for 12h and renew them one hour before they expire
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60
+VAPID_TOKEN_RENEWAL_MARGIN = 60 * 60
+
+_vapid_key: Vapid = None
+_vapid_headers: dict[str, tuple[int, dict]] = {}
+_vapid_lock = threading.Lock()
+
+
+def get_vapid_headers(endpoint: str) -> dict:
+    """
+    Get the VAPID authorization headers for the push service of the given endpoint.
+
+    The signed token only depends on the audience, the origin of the push service. It is therefore cached per origin
+    and only signed again shortly before it expires.
+    :param endpoint: the webpush endpoint
+    :return: a new dict with the VAPID headers
+    """
+    global _vapid_key
+    url = urlsplit(endpoint)
+    audience = f"{url.scheme}://{url.netloc}"
+    now = int(time.time())
+    with _vapid_lock:
+        cached = _vapid_headers.get(audience)
+        if cached is not None and cached[0] - VAPID_TOKEN_RENEWAL_MARGIN > now:
+            return dict(cached[1])
+
+        # evict all tokens about to expire, they would be signed again anyway
+        for expired_audience in [a for a, (expiry, _) in _vapid_headers.items()
+                                 if expiry - VAPID_TOKEN_RENEWAL_MARGIN <= now]:
+            del _vapid_headers[expired_audience]
+
+        if _vapid_key is None:
+            _vapid_key = Vapid.from_string(private_key=settings.WEB_PUSH_CONFIG_PRIVATE_KEY)
+
+        # web push claims
+        # aud: The “audience” is the destination URL of the push service.
+        # exp: The “expiration” date is the UTC time in seconds when the claim should expire. (not more than 24h
+        # sub: The “subscriber” is the primary contact email for this subscription.
+        expiry = now + VAPID_TOKEN_LIFETIME
+        claims = {
+            "sub": settings.WEB_PUSH_CONTACT,
+            "aud": audience,
+            "exp": expiry
+        }
+        headers = _vapid_key.sign(claims)
+        _vapid_headers[audience] = (expiry, headers)
+        return dict(headers)
+
+
 def create_subscription(token, bbox, data, user_agent):
     """
     create an encrypted unifiedPush subscription. This requires the additional parameter `p256dh_key` and `auth_key` in
@@ -48,7 +102,7 @@ def send_notification(endpoint, payload, auth_key, p256dh_key, persist_failures:
     :param payload: the message to encrypt and send
     :param auth_key: the key to authorize ourselves against the webpush server
     :param p256dh_key: encryption key
-    :param persist_failures: whether to record HTTP or network errors in the ConnectionFlag table
+    :param persist_failures: whether HTTP or network errors make us back off from the push server
     :return: Response if successful
     :raise: PushNotificationException if the request failed
     """
@@ -61,23 +115,15 @@ def send_notification(endpoint, payload, auth_key, p256dh_key, persist_failures:
             }
         }
 
-        # web push claims
-        # aud: The “audience” is the destination URL of the push service.
-        # exp: The “expiration” date is the UTC time in seconds when the claim should expire. (not more than 24h
-        # sub: The “subscriber” is the primary contact email for this subscription.
-        claims = {
-            "sub": settings.WEB_PUSH_CONTACT,
-            "exp": round(datetime.now().second + 86400)  # now + 24h
-        }
-
-        # check if this server has a timeout flag
-        checkTimeoutFlag(endpoint)
+        # wait for the rate limit of this server, or defer if it is in backoff
+        rate_limiter.acquire(endpoint)
 
-        return webpush(subscription_info,
-                       payload,
-                       vapid_private_key=settings.WEB_PUSH_CONFIG_PRIVATE_KEY,
-                       vapid_claims=claims,
-                       timeout=10)
+        pusher = WebPusher(subscription_info, requests_session=get_session())
+        response = pusher.send(payload, get_vapid_headers(endpoint), timeout=10)
+        if response.status_code > 202:
+            raise WebPushException(f"Push failed: {response.status_code} {response.reason}", response=response)
+        rate_limiter.report_success(endpoint)
+        return response
     except WebPushException as e:
         logger.error(f"Failed to send web push notification due to {e}")
         resp = getattr(e, "response", None)
@@ -93,19 +139,21 @@ def send_notification(endpoint, payload, auth_key, p256dh_key, persist_failures:
                     raise PushNotificationExpiredException(body)
                 case 429:
                     # The server responded with "too many requests" we have to wait until we try again.
+                    retry_after = retry_after_from_headers(resp.headers)
                     if persist_failures:
-                        setTimeoutFlag(endpoint, body)
+                        retry_after = rate_limiter.report_failure(endpoint, body, retry_after)
+                    raise PushNotificationException(status, retry_after=retry_after)
             raise PushNotificationException(status)
         raise PushNotificationException()
 
     except PushNotificationTimeoutException as e:
-        # do not set the timeout flag if the flag raised the exception
+        # do not extend the backoff if the rate limiter raised the exception
         logger.error(f"Failed to send web push notification due to {e}")
-        raise PushNotificationException("defer")
+        raise PushNotificationException("defer", retry_after=e.retry_after)
 
     except (ConnectTimeout, Timeout, ConnectionError, HTTPError, ReadTimeout, RequestException, OSError) as e:
         if persist_failures:
-            setTimeoutFlag(endpoint, str(e))
+            rate_limiter.report_failure(endpoint, str(e))
         logger.error(f"Failed to send web push notification due to {e}")
         if isinstance(e, ConnectTimeout) or isinstance(e, Timeout) or isinstance(e, ReadTimeout):
             raise PushNotificationException("timeout")
@@ -132,7 +180,9 @@ def update_subscription(token, request, subscription_id:str) -> HttpResponse:
     if p256dh_key == "" or auth_key == "":
         return HttpResponseBadRequest('invalid or missing parameters')
     try:
-        Subscription.objects.filter(id=subscription_id).update(token=token, auth_key=auth_key, p256dh_key=p256dh_key)
+        # update() doesn't set the modification time, it is needed to update the subscription index of the push workers
+        Subscription.objects.filter(id=subscription_id).update(token=token, auth_key=auth_key, p256dh_key=p256dh_key,
+                                                               modified=datetime.now(timezone.utc))
         return HttpResponse("Subscription and push config successfully updated")
     except Exception as e:
         logger.error(f"Can not update subscription: {e}")
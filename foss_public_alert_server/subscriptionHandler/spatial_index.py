@@ -0,0 +1,283 @@
+# SPDX-FileCopyrightText: Nucleus <nucleus-ffm@posteo.de>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import hashlib
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.db import connection
+from django.db.models import FloatField, Func
+
+from .models import Subscription
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the fields of a subscription identifying its push endpoint
+ENDPOINT_FIELDS = ('push_service', 'token', 'auth_key', 'p256dh_key')
+# the extent of a subscription's bounding box, computed by the database to not load and parse the geometries
+EXTENT_FIELDS = {f'bbox_{name}': Func('bounding_box', function=f'ST_{name}', output_field=FloatField())
+                 for name in ('XMin', 'YMin', 'XMax', 'YMax')}
+
+
+def endpoint_key(push_service: int, token: str, auth_key: str | None, p256dh_key: str | None) -> bytes:
+    """
+    a compact key identifying the push endpoint of a subscription, subscriptions with the same key receive identical
+    push notifications
+    """
+    endpoint = "\n".join((str(push_service), token, auth_key or "", p256dh_key or ""))
+    return hashlib.blake2b(endpoint.encode(), digest_size=16).digest()
+
+
+class SubscriptionIndex:
+    """
+    In-memory spatial index of the bounding boxes of all subscriptions, kept in each push notification worker process.
+
+    The bounding boxes are assigned to the cells of a regular grid, subscriptions covering too many cells are kept
+    in a separate list that is checked for every alert. Matching an alert first takes the subscriptions of the grid
+    cells touched by the alert's extent and compares the bounding boxes, without querying the database.
+    The remaining candidates are matched without any polygon math if they contain the entire extent of the alert or
+    cover a grid cell that lies completely inside the alert. Only subscriptions near the boundary of the alert need an
+    exact intersects test with the prepared alert geometry. The cells are classified once per alert and only when
+    needed, so this stays cheap for alerts with a huge number of vertices.
+
+    The index is synchronized with the database incrementally using the modification time of the subscriptions.
+    Deleted subscriptions are only removed by the periodic full rebuild, that's fine as the notification tasks
+    ignore subscriptions which don't exist anymore.
+
+    For each subscription a key of its push endpoint is kept as well, to find subscriptions of the same client.
+    """
+
+    def __init__(self, cell_size: float, max_cells: int):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self._lock = threading.Lock()
+        self._clear()
+        # monotonic time of the last full rebuild and incremental update, None if never done
+        self._rebuild_time = None
+        self._update_time = None
+        # subscriptions modified after this (database) time are not in the index yet
+        self._synced_until = None
+
+    def _clear(self) -> None:
+        """
+        Internal. Reset the index content.
+        """
+        # subscription id -> (min_x, min_y, max_x, max_y)
+        self._bboxes = {}
+        # subscription id -> endpoint key
+        self._endpoints = {}
+        # (cell x, cell y) -> set of subscription ids
+        self._cells = {}
+        # ids of subscriptions covering more than max_cells grid cells
+        self._large = set()
+
+    def _cell_range(self, bbox: tuple) -> (range, range):
+        """
+        Internal. The x and y ranges of the grid cells touched by the given bounding box.
+        """
+        min_x, min_y, max_x, max_y = bbox
+        return (range(math.floor(min_x / self.cell_size), math.floor(max_x / self.cell_size) + 1),
+                range(math.floor(min_y / self.cell_size), math.floor(max_y / self.cell_size) + 1))
+
+    def __len__(self):
+        return len(self._bboxes)
+
+    def add(self, subscription_id, bbox: tuple, endpoint: bytes = None) -> None:
+        """
+        Add a subscription to the index or update it.
+        :param subscription_id: the id of the subscription
+        :param bbox: the extent of the subscription's bounding box as (min_x, min_y, max_x, max_y) tuple
+        :param endpoint: the key of the subscription's push endpoint, see endpoint_key()
+        """
+        if subscription_id in self._bboxes:
+            self.remove(subscription_id)
+        self._bboxes[subscription_id] = bbox
+        if endpoint is not None:
+            self._endpoints[subscription_id] = endpoint
+        x_range, y_range = self._cell_range(bbox)
+        if len(x_range) * len(y_range) > self.max_cells:
+            self._large.add(subscription_id)
+            return
+        for x in x_range:
+            for y in y_range:
+                self._cells.setdefault((x, y), set()).add(subscription_id)
+
+    def remove(self, subscription_id) -> None:
+        """
+        Remove a subscription from the index, nothing happens if it is not in there.
+        """
+        bbox = self._bboxes.pop(subscription_id, None)
+        if bbox is None:
+            return
+        self._endpoints.pop(subscription_id, None)
+        if subscription_id in self._large:
+            self._large.discard(subscription_id)
+            return
+        x_range, y_range = self._cell_range(bbox)
+        for x in x_range:
+            for y in y_range:
+                cell = self._cells.get((x, y))
+                if cell is not None:
+                    cell.discard(subscription_id)
+                    if not cell:
+                        del self._cells[(x, y)]
+
+    def _candidates(self, extent: tuple) -> set:
+        """
+        Internal. The ids of all subscriptions whose bounding box intersects the given extent.
+        """
+        min_x, min_y, max_x, max_y = extent
+        ids = set(self._large)
+        x_range, y_range = self._cell_range(extent)
+        if len(x_range) * len(y_range) > len(self._cells):
+            # the extent covers more cells than are occupied, iterate over the occupied ones instead
+            cells = [cell for key, cell in self._cells.items() if key[0] in x_range and key[1] in y_range]
+        else:
+            cells = [self._cells[(x, y)] for x in x_range for y in y_range if (x, y) in self._cells]
+        for cell in cells:
+            ids |= cell
+        result = set()
+        for subscription_id in ids:
+            bbox = self._bboxes[subscription_id]
+            if bbox[0] <= max_x and bbox[2] >= min_x and bbox[1] <= max_y and bbox[3] >= min_y:
+                result.add(subscription_id)
+        return result
+
+    def intersecting(self, area: GEOSGeometry) -> list:
+        """
+        Find all subscriptions whose bounding box intersects the given area.
+        :param area: the area of an alert
+        :return: a list of subscription ids
+        """
+        if area.empty:
+            return []
+        extent = area.extent
+        with self._lock:
+            candidates = [(subscription_id, self._bboxes[subscription_id])
+                          for subscription_id in self._candidates(extent)]
+
+        prepared_area = area.prepared
+        cell_states = {}
+
+        def cell_state(cell: tuple) -> int:
+            """
+            whether the grid cell is completely inside the area (1), intersects its boundary (0) or is outside (-1)
+            """
+            if cell not in cell_states:
+                cell_bbox = Polygon.from_bbox((cell[0] * self.cell_size, cell[1] * self.cell_size,
+                                               (cell[0] + 1) * self.cell_size, (cell[1] + 1) * self.cell_size))
+                if prepared_area.contains(cell_bbox):
+                    cell_states[cell] = 1
+                else:
+                    cell_states[cell] = 0 if prepared_area.intersects(cell_bbox) else -1
+            return cell_states[cell]
+
+        area_x_range, area_y_range = self._cell_range(extent)
+        result = []
+        for subscription_id, bbox in candidates:
+            # the subscription contains the entire alert
+            if bbox[0] <= extent[0] and bbox[1] <= extent[1] and bbox[2] >= extent[2] and bbox[3] >= extent[3]:
+                result.append(subscription_id)
+                continue
+
+            # classify the grid cells covered by the subscription, outside the alert's extent there is nothing to find
+            x_range, y_range = self._cell_range(bbox)
+            x_range = range(max(x_range.start, area_x_range.start), min(x_range.stop, area_x_range.stop))
+            y_range = range(max(y_range.start, area_y_range.start), min(y_range.stop, area_y_range.stop))
+            states = {cell_state((x, y)) for x in x_range for y in y_range}
+            if 1 in states:
+                # the subscription touches a cell entirely inside the alert
+                result.append(subscription_id)
+            elif 0 in states and prepared_area.intersects(Polygon.from_bbox(bbox)):
+                result.append(subscription_id)
+        return result
+
+    def group_by_endpoint(self, subscription_ids: list) -> list[list]:
+        """
+        Group the given subscriptions by their push endpoint, e.g. for clients with several overlapping subscriptions.
+        :param subscription_ids: ids of subscriptions in the index
+        :return: a list of lists of subscription ids with the same endpoint, in the order of their first occurrence
+        """
+        groups = {}
+        with self._lock:
+            for subscription_id in subscription_ids:
+                key = self._endpoints.get(subscription_id, subscription_id)
+                groups.setdefault(key, []).append(subscription_id)
+        return list(groups.values())
+
+    @staticmethod
+    def _extents(subscriptions):
+        """
+        Internal. Query the id, the extent and the endpoint fields of the given subscriptions.
+        :return: a generator of (id, (min_x, min_y, max_x, max_y), endpoint key) tuples
+        """
+        for subscription_id, min_x, min_y, max_x, max_y, *endpoint in (
+                subscriptions.annotate(**EXTENT_FIELDS).values_list('id', *EXTENT_FIELDS, *ENDPOINT_FIELDS)
+                .iterator(chunk_size=10000)):
+            yield subscription_id, (min_x, min_y, max_x, max_y), endpoint_key(*endpoint)
+
+    def rebuild(self) -> None:
+        """
+        Load the extents of all subscriptions from the database and replace the content of the index.
+        """
+        start = time.monotonic()
+        synced_until = datetime.now(timezone.utc)
+        index = SubscriptionIndex(self.cell_size, self.max_cells)
+        for subscription_id, bbox, endpoint in self._extents(Subscription.objects.all()):
+            index.add(subscription_id, bbox, endpoint)
+        with self._lock:
+            self._bboxes, self._cells, self._large = index._bboxes, index._cells, index._large
+            self._endpoints = index._endpoints
+            self._synced_until = synced_until
+            self._rebuild_time = self._update_time = time.monotonic()
+        logger.info(f"Indexed {len(index)} subscriptions in {time.monotonic() - start:.1f}s")
+
+    def update(self) -> None:
+        """
+        Add all subscriptions created or modified since the last synchronization to the index.
+        """
+        # include subscriptions modified shortly before the last synchronization whose transaction wasn't committed yet
+        since = self._synced_until - timedelta(seconds=settings.SUBSCRIPTION_INDEX_SYNC_MARGIN)
+        synced_until = datetime.now(timezone.utc)
+        changes = list(self._extents(Subscription.objects.filter(modified__gte=since)))
+        with self._lock:
+            for subscription_id, bbox, endpoint in changes:
+                self.add(subscription_id, bbox, endpoint)
+            self._synced_until = synced_until
+            self._update_time = time.monotonic()
+
+    def _rebuild_periodically(self) -> None:
+        """
+        Internal. Rebuild the index every SUBSCRIPTION_INDEX_REBUILD_INTERVAL seconds, runs in a background thread.
+        """
+        while True:
+            time.sleep(settings.SUBSCRIPTION_INDEX_REBUILD_INTERVAL)
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.exception("Failed to rebuild the subscription index", exc_info=e)
+            finally:
+                # don't keep the database connection of this thread open until the next rebuild
+                connection.close()
+
+    def sync(self) -> None:
+        """
+        Bring the index up to date with the database if necessary, depending on the time since the last update.
+        The full rebuild is only done here if the index was never built, later ones are done by a background thread
+        of this process, which is started lazily so that it runs in the forked worker processes.
+        """
+        if self._rebuild_time is None:
+            self.rebuild()
+            threading.Thread(target=self._rebuild_periodically, name="subscription-index", daemon=True).start()
+        elif time.monotonic() - self._update_time >= settings.SUBSCRIPTION_INDEX_UPDATE_INTERVAL:
+            self.update()
+
+
+# the index of this process, synchronized on demand by the fan out task and rebuilt periodically
+subscription_index = SubscriptionIndex(settings.SUBSCRIPTION_INDEX_GRID, settings.SUBSCRIPTION_INDEX_MAX_CELLS)
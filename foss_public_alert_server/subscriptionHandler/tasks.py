@@ -3,17 +3,24 @@
 
 import json
 import logging
+import math
+import time
+from urllib.parse import urlsplit
 
 from datetime import datetime, timedelta, timezone
 from celery import shared_task, Task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
 
 from alertHandler.models import Alert
 from requests import ReadTimeout, RequestException, HTTPError, ConnectionError
 
 from .exceptions import PushNotificationException, PushNotificationExpiredException
 from .models import Subscription
+from .spatial_index import subscription_index
 from configuration.models import AppSetting
-from .push_notification_services import unified_push, apn, firebase, unified_push_encrpted
+from .push_notification_services import delivery
 
 from prometheus_client import Counter
 
@@ -41,18 +48,7 @@ def remove_old_subscription():
                       " Please renew your subscription."}
     for subscription in Subscription.objects.filter(last_heartbeat__lt=cutoff_time):
         try:
-            match subscription.push_service:
-                case subscription.PushServices.UNIFIED_PUSH:
-                    unified_push.send_notification(subscription.token, json.dumps(msg))
-                case subscription.PushServices.UNIFIED_PUSH_ENCRYPTED:
-                    unified_push_encrpted.send_notification(subscription.token,
-                                                            json.dumps(msg),
-                                                            auth_key=subscription.auth_key,
-                                                            p256dh_key=subscription.p256dh_key)
-                case subscription.PushServices.APN:
-                    apn.send_notification(subscription.token, "", "", "", "", "")
-                case subscription.PushServices.FIREBASE:
-                    firebase.send_notification(subscription.token, json.dumps(msg))
+            delivery.send_notification(subscription, json.dumps(msg))
         except (PushNotificationException, ConnectionError, HTTPError, ReadTimeout, RequestException):
             pass
         subscription.delete()
@@ -77,18 +73,17 @@ class NotificationBaseTask(Task):
         # This avoids deleting subscriptions due to internal errors
         subscription_id = args[0]
         if isinstance(exc, PushNotificationException):
-            # increase error counter by one
+            # increase error counter by one, with an update query to not touch the modification time of the
+            # subscription, which would make the subscription index reload it
             logger.debug(f"Increase error counter of subscription {subscription_id}")
-            subscription = Subscription.objects.get(id=subscription_id)
-            subscription.error_counter += 1
+            Subscription.objects.filter(id=subscription_id).update(error_counter=F('error_counter') + 1)
 
             # delete subscription of error counter exceeds the max number
-            if subscription.error_counter > AppSetting.get("NUMBER_OF_PUSH_ERRORS_BEFORE_DELETING"):
+            deleted, _ = Subscription.objects.filter(
+                id=subscription_id, error_counter__gt=AppSetting.get("NUMBER_OF_PUSH_ERRORS_BEFORE_DELETING")).delete()
+            if deleted:
                 logger.debug(f"Subscription {subscription_id} has reached the max error number. Deleting.")
-                subscription.delete()
                 push_expire_metric.labels("error").inc(1)
-            else:
-                subscription.save()
         elif isinstance(exc, PushNotificationExpiredException):
             # The push notification subscription on the push server expired,
             # we can not push anymore to this server
@@ -107,9 +102,7 @@ class NotificationBaseTask(Task):
         :return: None
         """
         subscription_id = args[0]
-        subscription = Subscription.objects.get(id=subscription_id)
-        subscription.error_counter = 0
-        subscription.save()
+        Subscription.objects.filter(id=subscription_id, error_counter__gt=0).update(error_counter=0)
 
 @shared_task(name="task.send_notification",
              bind=True,
@@ -133,40 +126,163 @@ def send_one_notification(self, subscription_id, msg)  -> None:
     subscription = Subscription.objects.get(id=subscription_id)
     logger.debug("Sending push notification")
     try:
-        match subscription.push_service:
-            case subscription.PushServices.UNIFIED_PUSH:
-                unified_push.send_notification(subscription.token, json.dumps(msg))
-            case subscription.PushServices.UNIFIED_PUSH_ENCRYPTED:
-                unified_push_encrpted.send_notification(subscription.token,
-                                                        json.dumps(msg),
-                                                        auth_key=subscription.auth_key,
-                                                        p256dh_key=subscription.p256dh_key)
-            case subscription.PushServices.APN:
-                apn.send_notification(subscription.token, "", "", "", "", "")
-            case subscription.PushServices.FIREBASE:
-                firebase.send_notification(subscription.token, json.dumps(msg))
+        delivery.send_notification(subscription, json.dumps(msg))
     except PushNotificationException as e:
         push_post_metric.labels(e.error_code).inc(1)
+        if e.retry_after is not None:
+            # the push server is rate limited, try again as soon as we may send to it again
+            raise self.retry(countdown=math.ceil(e.retry_after))
         # reraise exception to make the task fail, to use the retry policy
         raise PushNotificationException
     push_post_metric.labels("200").inc(1)
 
 
-def check_for_alerts_and_send_notifications(alert: Alert, is_update: bool = False) -> None:
+@shared_task(name="task.send_notifications")
+def send_notifications(subscription_ids: list, msg, deferrals: int = 0) -> None:
     """
-    check for the given alert if there is a subscription that wants to get a notification
+    send the same push notification to a batch of subscriptions.
+
+    All subscriptions of the batch are loaded with one query and notified concurrently. Subscriptions with the same
+    push endpoint get the notification only once, the first one of them is used for the delivery. Subscriptions whose
+    delivery failed are handed over to send_one_notification to use its retry policy and error counter handling.
+    Deliveries deferred because of the rate limit or backoff of their push server are queued again as one batch
+    per push server, to be sent once the server accepts requests again. After PUSH_MAX_DEFERRALS deferrals the
+    notification is dropped.
+    :param subscription_ids: the ids of the subscriptions to notify
+    :param msg: the payload to send via the push notification
+    :param deferrals: how often the delivery to these subscriptions was deferred already
     :return: None
     """
+    payload = json.dumps(msg)
+    delivered = []
+    # deferred subscriptions by push server host, with the time in seconds until the server accepts requests again
+    deferred = {}
+    # subscriptions with the same endpoint, by the id of the subscription used for the delivery
+    endpoints = {}
+    for subscription in Subscription.objects.filter(id__in=subscription_ids):
+        endpoint = (subscription.push_service, subscription.token, subscription.auth_key, subscription.p256dh_key)
+        endpoints.setdefault(endpoint, []).append(subscription)
+    subscriptions = {group[0].id: group for group in endpoints.values()}
+
+    for subscription, exc in delivery.send_notifications([group[0] for group in endpoints.values()], payload):
+        if exc is None:
+            push_post_metric.labels("200").inc(1)
+            delivered += [s.id for s in subscriptions[subscription.id]]
+        elif isinstance(exc, PushNotificationExpiredException):
+            logger.debug(f"Subscription {subscription.id} has an expired push registration. Deleting.")
+            Subscription.objects.filter(id__in=[s.id for s in subscriptions[subscription.id]]).delete()
+            push_expire_metric.labels("expired").inc(len(subscriptions[subscription.id]))
+        elif isinstance(exc, PushNotificationException) and exc.retry_after is not None:
+            push_post_metric.labels(exc.error_code).inc(1)
+            host = urlsplit(subscription.token).hostname
+            ids, countdown = deferred.get(host, ([], 0))
+            ids.append(str(subscription.id))
+            deferred[host] = (ids, max(countdown, exc.retry_after))
+        elif isinstance(exc, PushNotificationException):
+            push_post_metric.labels(exc.error_code).inc(1)
+            # retry this subscription on its own, with the backoff and error counter of the single notification task
+            send_one_notification.apply_async(
+                args=[str(subscription.id), msg],
+                countdown=1,
+                queue='push_notifications'
+            )
+        else:
+            logger.error(f"Failed to send push notification to subscription {subscription.id}", exc_info=exc)
+            # don't drop the notification, the single notification task applies its own policy to the failure
+            send_one_notification.apply_async(
+                args=[str(subscription.id), msg],
+                countdown=1,
+                queue='push_notifications'
+            )
+
+    # reset the error counter of every successfully notified subscription in one query
+    Subscription.objects.filter(id__in=delivered, error_counter__gt=0).update(error_counter=0)
+
+    for host, (ids, countdown) in deferred.items():
+        if deferrals >= settings.PUSH_MAX_DEFERRALS:
+            logger.warning(f"Dropping notification for {len(ids)} subscriptions at {host}, deferred too often")
+            push_post_metric.labels("dropped").inc(len(ids))
+            continue
+        send_notifications.apply_async(
+            args=[ids, msg, deferrals + 1],
+            countdown=max(1, math.ceil(countdown)),
+            queue='push_notifications'
+        )
+
+
+def _pending_update_key(alert_id: str) -> str:
+    """
+    Internal. The cache key marking that an update fan out for the given alert is scheduled already.
+    """
+    return f"pending-alert-update:{alert_id}"
+
+
+def _recent_update_key(alert_id: str) -> str:
+    """
+    Internal. The cache key holding the time an update of the given alert was last sent without delay.
+    """
+    return f"recent-alert-update:{alert_id}"
+
+
+@shared_task(name="task.fan_out_notifications")
+def fan_out_notifications(alert_id: str, is_update: bool = False) -> None:
+    """
+    find all subscriptions that intersect with the given alert and queue batched notification tasks for them
+    :param alert_id: the database id of the alert
+    :param is_update: true if the alert is an update of an already known alert
+    :return: None
+    """
+    if is_update:
+        # updates from now on need another fan out, this one might not see them anymore
+        cache.delete(_pending_update_key(alert_id))
+    try:
+        area = Alert.objects.values_list('area', flat=True).get(id=alert_id)
+    except Alert.DoesNotExist:
+        logger.debug(f"Alert {alert_id} no longer exists, skipping notifications")
+        return
+
     msg = {
         'type': 'added' if not is_update else 'update',
-        'alert_id': str(alert.id)
+        'alert_id': str(alert_id)
         }
-    for subscription in Subscription.objects.filter(bounding_box__intersects=alert.area):
-        # send push notification task to celery to free the alert parsing worker
-        send_one_notification.apply_async(
-            args=[subscription.id, msg],
-            # @TODO(Nucleus): we may want to use task routes instead of hardcoding the queue name here
-            queue='push_notifications'
-        )
-        # @TODO(Nucleus): check performance
-    pass
+    subscription_index.sync()
+    # subscriptions with the same push endpoint are kept in the same batch, so that they are notified only once
+    batches = [[]]
+    for group in subscription_index.group_by_endpoint(subscription_index.intersecting(area)):
+        if len(batches[-1]) >= settings.PUSH_NOTIFICATION_BATCH_SIZE:
+            batches.append([])
+        batches[-1] += group
+    for batch in batches:
+        if batch:
+            send_notifications.apply_async(
+                args=[[str(subscription_id) for subscription_id in batch], msg],
+                queue='push_notifications'
+            )
+
+
+def check_for_alerts_and_send_notifications(alert: Alert, is_update: bool = False) -> None:
+    """
+    check for the given alert if there is a subscription that wants to get a notification
+    The actual lookup and sending is done by the push notification worker to free the alert parsing worker.
+
+    An update is sent immediately, unless another update of the same alert was sent within the last
+    ALERT_UPDATE_COALESCING_WINDOW seconds. Then the notifications are sent once that window has passed, all further
+    updates of the alert until then are covered by the already scheduled fan out, as it reads the latest state of the
+    alert when it runs.
+    :return: None
+    """
+    countdown = None
+    window = settings.ALERT_UPDATE_COALESCING_WINDOW
+    if is_update and window > 0:
+        now = time.time()
+        if not cache.add(_recent_update_key(str(alert.id)), now, timeout=window):
+            sent = cache.get(_recent_update_key(str(alert.id)), now)
+            countdown = max(1, math.ceil(sent + window - now))
+            # the key expires eventually in case the scheduled fan out gets lost
+            if not cache.add(_pending_update_key(str(alert.id)), True, timeout=countdown + window):
+                logger.debug(f"Notifications for an update of alert {alert.id} are scheduled already")
+                return
+
+    # @TODO(Nucleus): we may want to use task routes instead of hardcoding the queue name here
+    fan_out_notifications.apply_async(args=[str(alert.id), is_update], countdown=countdown,
+                                      queue='push_notifications')
@@ -5,14 +5,21 @@ import datetime
 import json
 import logging
 import requests
+from unittest.mock import MagicMock, patch
 
-from django.contrib.gis.geos import Polygon
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.test import TestCase, override_settings
 from django.test import Client
 
 from alertHandler.models import Alert
-from .models import Subscription, ConnectionFlag
-from .tasks import remove_old_subscription
+from .models import Subscription
+from .exceptions import PushNotificationException, PushNotificationTimeoutException
+from .push_notification_services import unified_push
+from .push_notification_services.push_tools import HostRateLimiter, rate_limiter
+from .spatial_index import SubscriptionIndex, subscription_index
+from .tasks import remove_old_subscription, fan_out_notifications, send_notifications, send_one_notification, \
+    check_for_alerts_and_send_notifications
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -132,14 +139,15 @@ class SubscriptionHandlerTestsCase(TestCase):
             'https://500.returnco.de/whatever',  # 500
             # TODO timeouting endpoint
         ]
-        flag_count = ConnectionFlag.objects.count()
         for url in urls:
             for service in ['UNIFIED_PUSH', 'UNIFIED_PUSH_ENCRYPTED']:
                 data['push_service'] = service
                 data['token'] = url
                 response = self.client.post('/subscription/', data, content_type="application/json")
                 self.assertEqual(response.status_code, 400)
-        self.assertEqual(flag_count, ConnectionFlag.objects.count())
+        # failed test pushes must not make us back off from the push server
+        for url in urls:
+            self.assertFalse(rate_limiter.is_throttled(url))
 
     def test_send_notification(self):
         for alert in Alert.objects.all():
@@ -251,3 +259,205 @@ class SubscriptionHandlerTestsCase(TestCase):
         self.assertEqual(Subscription.objects.count(), prev_count + 1)
         remove_old_subscription()
         self.assertEqual(Subscription.objects.count(), prev_count)
+
+    @override_settings(PUSH_NOTIFICATION_BATCH_SIZE=2)
+    def test_fan_out_notifications_in_batches(self):
+        for i in range(3):
+            Subscription(token=f"https://unifiedpush.kde.org/fan-out-{i}",
+                         bounding_box=Polygon.from_bbox((8.591, 52.295, 12.063, 52.789))).save()
+        # a subscription outside the alert area
+        Subscription(token="https://unifiedpush.kde.org/fan-out-outside",
+                     bounding_box=Polygon.from_bbox((-10.0, -10.0, -9.0, -9.0))).save()
+        alert = Alert(source_id="Test_source_id", alert_id="fan-out-test",
+                      issue_time=datetime.datetime.now(datetime.timezone.utc),
+                      area=MultiPolygon(Polygon.from_bbox((9.0, 52.0, 10.0, 53.0))))
+        alert.save()
+
+        subscription_index.rebuild()
+        with patch.object(send_notifications, 'apply_async') as apply_async:
+            fan_out_notifications(str(alert.id))
+
+        self.assertEqual(apply_async.call_count, 2)
+        notified_ids = [i for call in apply_async.call_args_list for i in call.kwargs['args'][0]]
+        self.assertEqual(len(notified_ids), 3)
+        self.assertEqual(apply_async.call_args_list[0].kwargs['args'][1], {'type': 'added', 'alert_id': str(alert.id)})
+
+    def test_subscription_index(self):
+        index = SubscriptionIndex(cell_size=1.0, max_cells=4)
+        inside = Subscription(token="https://unifiedpush.kde.org/index-inside",
+                              bounding_box=Polygon.from_bbox((9.2, 52.2, 9.4, 52.4)))
+        inside.save()
+        index.rebuild()
+        self.assertIn(inside.id, index.intersecting(MultiPolygon(Polygon.from_bbox((9.0, 52.0, 10.0, 53.0)))))
+
+        # new subscriptions are picked up by the incremental update
+        large = Subscription(token="https://unifiedpush.kde.org/index-large",
+                             bounding_box=Polygon.from_bbox((0.0, 40.0, 20.0, 60.0)))
+        large.save()
+        # only the bounding box of this one intersects the triangle
+        corner = Subscription(token="https://unifiedpush.kde.org/index-corner",
+                              bounding_box=Polygon.from_bbox((9.8, 52.8, 9.9, 52.9)))
+        corner.save()
+        index.update()
+        triangle = MultiPolygon(Polygon(((9.0, 52.0), (10.0, 52.0), (9.0, 53.0), (9.0, 52.0))))
+        self.assertCountEqual(index.intersecting(triangle), [inside.id, large.id])
+
+        index.remove(large.id)
+        self.assertEqual(index.intersecting(triangle), [inside.id])
+        self.assertEqual(index.intersecting(MultiPolygon(Polygon.from_bbox((-10.0, -10.0, -9.0, -9.0)))), [])
+
+        # deleted subscriptions are only removed by the full rebuild, syncing an existing index doesn't do that
+        inside_id = inside.id
+        inside.delete()
+        index.sync()
+        self.assertEqual(index.intersecting(triangle), [inside_id])
+        index.rebuild()
+        self.assertEqual(index.intersecting(triangle), [large.id])
+
+    def test_subscription_index_matching(self):
+        index = SubscriptionIndex(cell_size=1.0, max_cells=400)
+        # an L-shaped alert, its extent is (0, 0, 10, 10)
+        alert_area = MultiPolygon(Polygon(((0.0, 0.0), (10.0, 0.0), (10.0, 2.0), (2.0, 2.0), (2.0, 10.0), (0.0, 10.0),
+                                           (0.0, 0.0))))
+        index.add("contains-alert", (-1.0, -1.0, 11.0, 11.0))
+        index.add("interior", (0.2, 0.2, 0.4, 0.4))
+        index.add("inside-cell", (0.5, 3.5, 4.0, 4.0))
+        index.add("boundary", (1.5, 1.5, 2.5, 2.5))
+        index.add("in-extent-only", (5.0, 5.0, 6.0, 6.0))
+        index.add("outside", (20.0, 20.0, 21.0, 21.0))
+        self.assertCountEqual(index.intersecting(alert_area), ["contains-alert", "interior", "inside-cell", "boundary"])
+
+    def test_send_notifications_once_per_endpoint(self):
+        bbox = Polygon.from_bbox((8.591, 52.295, 12.063, 52.789))
+        token = "https://unifiedpush.kde.org/same-endpoint"
+        subscriptions = [Subscription(token=token, bounding_box=bbox) for _ in range(3)]
+        subscriptions.append(Subscription(token="https://unifiedpush.kde.org/other-endpoint", bounding_box=bbox))
+        for subscription in subscriptions:
+            subscription.save()
+
+        index = SubscriptionIndex(cell_size=1.0, max_cells=400)
+        index.rebuild()
+        groups = index.group_by_endpoint([s.id for s in subscriptions])
+        self.assertCountEqual([len(group) for group in groups], [3, 1])
+
+        with patch('subscriptionHandler.push_notification_services.delivery.send_notifications',
+                   side_effect=lambda subs, payload: [(s, None) for s in subs]) as send:
+            send_notifications([str(s.id) for s in subscriptions], {'type': 'added', 'alert_id': 'test'})
+        self.assertEqual(len(send.call_args.args[0]), 2)
+
+    def test_coalesce_alert_updates(self):
+        alert = Alert(source_id="Test_source_id", alert_id="coalescing-test",
+                      issue_time=datetime.datetime.now(datetime.timezone.utc),
+                      area=MultiPolygon(Polygon.from_bbox((9.0, 52.0, 10.0, 53.0))))
+        alert.save()
+
+        with patch.object(fan_out_notifications, 'apply_async') as apply_async:
+            check_for_alerts_and_send_notifications(alert)
+            for i in range(3):
+                check_for_alerts_and_send_notifications(alert, True)
+        # the new alert and its first update are sent immediately, the further updates only once after the window
+        self.assertEqual(apply_async.call_count, 3)
+        self.assertIsNone(apply_async.call_args_list[0].kwargs['countdown'])
+        self.assertIsNone(apply_async.call_args_list[1].kwargs['countdown'])
+        self.assertAlmostEqual(apply_async.call_args_list[2].kwargs['countdown'], settings.ALERT_UPDATE_COALESCING_WINDOW,
+                               delta=5)
+
+        # once the scheduled fan out runs, further updates are scheduled again
+        with patch.object(send_notifications, 'apply_async'):
+            fan_out_notifications(str(alert.id), True)
+        with patch.object(fan_out_notifications, 'apply_async') as apply_async:
+            check_for_alerts_and_send_notifications(alert, True)
+        self.assertEqual(apply_async.call_count, 1)
+
+    def test_push_host_backoff(self):
+        limiter = HostRateLimiter()
+        limiter.acquire("https://backoff.example.org/a")
+        limiter.report_failure("https://backoff.example.org/a", "Too Many Requests", retry_after=60)
+        with self.assertRaises(PushNotificationTimeoutException) as cm:
+            limiter.acquire("https://backoff.example.org/b")
+        self.assertAlmostEqual(cm.exception.retry_after, 60, delta=5)
+        # other hosts are not affected, other worker processes see the backoff as well
+        limiter.acquire("https://other.example.org/a")
+        self.assertTrue(HostRateLimiter().is_throttled("https://backoff.example.org/c"))
+
+    def test_push_host_backoff_concurrent_failures(self):
+        limiter = HostRateLimiter()
+        # the concurrent requests of one outage only count as a single failure
+        delays = [limiter.report_failure("https://outage.example.org/a", "Connection refused") for _ in range(8)]
+        self.assertAlmostEqual(max(delays), settings.PUSH_HOST_BACKOFF_MIN, delta=1)
+
+    def test_unified_push_too_many_requests(self):
+        response = MagicMock(status_code=429, headers={'Retry-After': '30'}, text="Too Many Requests")
+        with patch('subscriptionHandler.push_notification_services.unified_push.get_session') as get_session:
+            get_session.return_value.post.return_value = response
+            with self.assertRaises(PushNotificationException) as cm:
+                unified_push.send_notification("https://throttled.example.org/a", "{}")
+        # the notification is deferred until the push server accepts requests again
+        self.assertEqual(cm.exception.error_code, "429")
+        self.assertAlmostEqual(cm.exception.retry_after, 30, delta=5)
+
+    def test_send_notifications_retries_unexpected_errors(self):
+        subscription = Subscription(token="https://unifiedpush.kde.org/unexpected-error",
+                                    bounding_box=Polygon.from_bbox((8.591, 52.295, 12.063, 52.789)))
+        subscription.save()
+        with patch('subscriptionHandler.push_notification_services.delivery.send_notifications',
+                   side_effect=lambda subs, payload: [(s, RuntimeError("unexpected")) for s in subs]), \
+                patch.object(send_one_notification, 'apply_async') as apply_async:
+            send_notifications([str(subscription.id)], {'type': 'added', 'alert_id': 'test'})
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(apply_async.call_args.kwargs['args'][0], str(subscription.id))
+
+    def test_send_notifications_defers_batch(self):
+        bbox = Polygon.from_bbox((8.591, 52.295, 12.063, 52.789))
+        subscriptions = [Subscription(token=f"https://unifiedpush.kde.org/deferred-{i}", bounding_box=bbox)
+                         for i in range(3)]
+        subscriptions.append(Subscription(token="https://other.example.org/deferred", bounding_box=bbox))
+        for subscription in subscriptions:
+            subscription.save()
+        retry_after = {s.token: t for s, t in zip(subscriptions, [2.5, 4, 1, 60])}
+
+        with patch('subscriptionHandler.push_notification_services.delivery.send_notifications',
+                   side_effect=lambda subs, payload: [(s, PushNotificationException("defer", retry_after[s.token]))
+                                                      for s in subs]), \
+                patch.object(send_notifications, 'apply_async') as apply_async:
+            send_notifications([str(s.id) for s in subscriptions], {'type': 'added', 'alert_id': 'test'})
+        # the deferred subscriptions are queued again as one batch per push server
+        self.assertCountEqual([(len(call.kwargs['args'][0]), call.kwargs['countdown']) for call in apply_async.call_args_list],
+                              [(3, 4), (1, 60)])
+        self.assertEqual(apply_async.call_args.kwargs['args'][2], 1)
+
+        # notifications deferred too often are dropped
+        with patch('subscriptionHandler.push_notification_services.delivery.send_notifications',
+                   side_effect=lambda subs, payload: [(s, PushNotificationException("defer", retry_after[s.token]))
+                                                      for s in subs]), \
+                patch.object(send_notifications, 'apply_async') as apply_async:
+            send_notifications([str(s.id) for s in subscriptions], {'type': 'added', 'alert_id': 'test'},
+                               settings.PUSH_MAX_DEFERRALS)
+        apply_async.assert_not_called()
+
+    @override_settings(PUSH_HOST_RATE=1000, PUSH_HOST_BURST=1, PUSH_HOST_MAX_WAIT=0.5,
+                       PUSH_HOST_RATE_LIMITS={"slow.example.org": 1})
+    def test_push_host_rate_limits(self):
+        limiter = HostRateLimiter()
+        limiter.acquire("https://fast.example.org/a")
+        limiter.acquire("https://fast.example.org/b")
+        limiter.acquire("https://slow.example.org/a")
+        # the configured rate of this host makes the next request wait too long
+        with self.assertRaises(PushNotificationTimeoutException) as cm:
+            limiter.acquire("https://slow.example.org/b")
+        self.assertAlmostEqual(cm.exception.retry_after, 1, delta=0.1)
+
+    def test_notification_error_counter(self):
+        subscription = Subscription(token="https://unifiedpush.kde.org/error-counter",
+                                    bounding_box=Polygon.from_bbox((8.591, 52.295, 12.063, 52.789)))
+        subscription.save()
+        modified = subscription.modified
+
+        send_one_notification.on_failure(PushNotificationException("failure"), None, [str(subscription.id)], {}, None)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.error_counter, 1)
+        send_one_notification.on_success(None, None, [str(subscription.id)], {})
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.error_counter, 0)
+        # the subscription index doesn't have to reload the subscription
+        self.assertEqual(subscription.modified, modified)